@@ -5,13 +5,18 @@ move game logic to another file. Ideally the API will be simple, concerned
 primarily with communication to/from the API's users."""
 
 
+import datetime
+import logging
+
 import endpoints
 
 from protorpc import remote, messages
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
+from google.appengine.api import datastore_errors, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 
-from models import User, Game, GameHistory, Player, Dice, Score
+from models import User, Game, GameHistory, GameHistoryBucket, Player
+from models import Dice, Score
 from models import (
     StringMessage,
     NewGameForm,
@@ -19,31 +24,268 @@ from models import (
     GameForms,
     RaiseBidForm,
     DiceForms,
+    OddsForm,
     GameHistoryForm,
     GameHistoryForms,
-    ScoreForms)
-from utils import get_by_urlsafe
+    ScoreForms,
+    SessionForm,
+    DashboardForm,
+    DashboardForms,
+    RaiseBidsForm)
+from auth import issue_token, token_user_id, verify_token
+import instrumentation
+import leaderboard
+import notifications
+import rules
+import scoring
+from utils import get_by_urlsafe, get_multi_by_urlsafe, get_multi_cached
+from utils import invalidate
+from utils import cache_entity, cache_entity_async
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),)
+POLL_GAME_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    version=messages.IntegerField(2),)
 GET_USER_GAMES_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1),
-    password=messages.StringField(2),)
+    password=messages.StringField(2),
+    token=messages.StringField(3),
+    cursor=messages.StringField(4),
+    limit=messages.IntegerField(5, default=20),)
 RAISE_BID_REQUEST = endpoints.ResourceContainer(
     RaiseBidForm,
     urlsafe_game_key=messages.StringField(1),)
 GET_DICE_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1),
     password=messages.StringField(2),
-    urlsafe_game_key=messages.StringField(3),)
+    urlsafe_game_key=messages.StringField(3),
+    token=messages.StringField(4),)
 CALL_LIAR_REQUEST = endpoints.ResourceContainer(
     password=messages.StringField(1),
-    urlsafe_game_key=messages.StringField(2))
+    urlsafe_game_key=messages.StringField(2),
+    token=messages.StringField(3),)
 USER_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1),
     email=messages.StringField(2),
     password=messages.StringField(3),)
+RANKINGS_REQUEST = endpoints.ResourceContainer(
+    cursor=messages.StringField(1),
+    limit=messages.IntegerField(2),)
+USER_RANK_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    neighbours=messages.IntegerField(2, default=leaderboard.NEIGHBOURS),)
+GET_GAMES_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_keys=messages.StringField(1, repeated=True),)
+GET_DASHBOARD_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_keys=messages.StringField(1, repeated=True),
+    user_name=messages.StringField(2),
+    password=messages.StringField(3),
+    token=messages.StringField(4),)
+RAISE_BIDS_REQUEST = endpoints.ResourceContainer(RaiseBidsForm)
+LOGIN_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    password=messages.StringField(2),)
+
+# Most games a batch endpoint accepts in one request
+MAX_BATCH_GAMES = 25
+
+
+def _check_batch(urlsafe_game_keys):
+    if len(urlsafe_game_keys) > MAX_BATCH_GAMES:
+        raise endpoints.BadRequestException(
+            'At most %d games can be requested at once.' % MAX_BATCH_GAMES)
+
+
+@ndb.tasklet
+def _check_password_async(user_key, password):
+    """Fetches the User and checks their password"""
+    user = yield user_key.get_async()
+    if not user:
+        raise endpoints.NotFoundException('User not found.')
+    if user.password != password:
+        raise endpoints.UnauthorizedException('Invalid password.')
+    raise ndb.Return(user)
+
+
+@ndb.tasklet
+def _authorize_async(request, user_key):
+    """Checks that the request may act as the user. A session token is
+    verified without any Datastore reads, otherwise falls back to the
+    password."""
+    if request.token:
+        if verify_token(request.token) != token_user_id(user_key):
+            raise endpoints.UnauthorizedException('Invalid session token.')
+    else:
+        yield _check_password_async(user_key, request.password)
+
+
+def _check_password(user_key, password):
+    return _check_password_async(user_key, password).get_result()
+
+
+def _authorize(request, user_key):
+    _authorize_async(request, user_key).get_result()
+
+
+@ndb.transactional(xg=True)
+def _create_user(user_name, email, password):
+    """Creates a User unless the name is already taken. Their Score is
+    created by the next score aggregation, from a signup event."""
+    user_key = User.key_for(user_name)
+    if user_key.get():
+        raise endpoints.ConflictException(
+                'A User with that name already exists!')
+    user = User(
+        key=user_key,
+        user_name=user_name,
+        email=email,
+        password=password)
+    ndb.put_multi([user, scoring.signup_event(user_key, user_name)])
+    return user
+
+
+@ndb.transactional_tasklet
+def _place_bid(game_key, turn, bid_face, bid_total):
+    """Applies a validated bid made against the given turn of a game and
+    appends it to the game's history. Raises a ConflictException if another
+    move got there first."""
+    bucket_key = GameHistoryBucket.key_for(game_key, turn + 1)
+    game, bucket = yield game_key.get_async(), bucket_key.get_async()
+    if game.game_over or game.cancelled or game.turn != turn:
+        # The caller may have been working from a stale cached copy
+        invalidate(game_key)
+        raise endpoints.ConflictException('The game has moved on. Fetch the '
+                                          'game and try again.')
+    # Game logic
+    game.bid_face = bid_face
+    game.bid_total = bid_total
+    game.turn += 1
+    game.version += 1
+    game.last_move = datetime.datetime.utcnow()
+    # Update player info
+    game.bid_player = rules.next_player(game.bid_player, game.players)
+
+    # Record History
+    if bucket is None:
+        bucket = GameHistoryBucket(key=bucket_key, first_turn=game.turn)
+    bucket.append(game.bid_player, game.bid_face, game.bid_total)
+    yield ndb.put_multi_async([game, bucket])
+    raise ndb.Return(game)
+
+
+@ndb.transactional_tasklet
+def _end_game(game_key, players, turn, winner):
+    """Ends the game at the given turn with a winner, reading the game and
+    its players together and writing them back in one batch. Raises a
+    ConflictException if another move got there first."""
+    game, player_entities = yield (
+        game_key.get_async(),
+        ndb.get_multi_async(Player.keys_for(game_key, players)))
+    if game.game_over or game.cancelled or game.turn != turn:
+        # The caller may have been working from a stale cached copy
+        invalidate(game_key)
+        raise endpoints.ConflictException('The game has moved on. Fetch the '
+                                          'game and try again.')
+    game.game_over = True
+    game.winner = winner
+    game.version += 1
+    yield (ndb.put_multi_async([game] + _deactivate(player_entities)),
+           scoring.queue_game_scores_async(game))
+    raise ndb.Return(game)
+
+
+@ndb.transactional_tasklet
+def _cancel_game(game_key, players):
+    """Cancels a game that is still in progress"""
+    game, player_entities = yield (
+        game_key.get_async(),
+        ndb.get_multi_async(Player.keys_for(game_key, players)))
+    if game.game_over or game.cancelled:
+        raise endpoints.ConflictException('Game already over!')
+    game.cancelled = True
+    game.version += 1
+    yield ndb.put_multi_async([game] + _deactivate(player_entities))
+    raise ndb.Return(game)
+
+
+def _deactivate(players):
+    """Marks a game's players as no longer active and returns them"""
+    players = [player for player in players if player is not None]
+    for player in players:
+        player.active = False
+    return players
+
+
+@ndb.tasklet
+def _raise_bid(game, bid_face, bid_total, request):
+    """Validates and applies a bid on a game, authorizing it with the
+    request's token or password. Returns the new GameForm."""
+    # Validity logic
+    if not game:
+        raise endpoints.NotFoundException('Game not found!')
+
+    if game.game_over or game.cancelled:
+        raise endpoints.ConflictException('Game already over!')
+
+    bidding_seat = game.turn_seat()
+    next_seat = game.seat(rules.next_player(game.bid_player + 1,
+                                            game.players))
+
+    yield _authorize_async(request, bidding_seat.user)
+
+    try:
+        rules.check_bid(bid_face, bid_total, game.bid_face, game.bid_total,
+                        game.die_faces, game.dice_total * game.players)
+    except rules.RuleError, e:
+        raise endpoints.BadRequestException(e.message)
+
+    # Game logic, applied in a transaction so concurrent moves on the
+    # same game cannot interleave
+    game = yield _place_bid(game.key, game.turn, bid_face, bid_total)
+    # Publish the new state and notify the next player side by side
+    yield (cache_entity_async(game),
+           notifications.notify_turn_async(next_seat))
+
+    raise ndb.Return(game.to_form(
+        'Current bid is now face: %d, number %d. It is %s\'s turn.'
+        % (bid_face, bid_total, next_seat.user_name)))
+
+
+@ndb.tasklet
+def _try_raise_bid(game, bid, request):
+    """Runs _raise_bid for one move of a batch. Returns None for a missing
+    game and the game's unchanged state if the move is rejected."""
+    if not game:
+        raise ndb.Return(None)
+    try:
+        form = yield _raise_bid(game, bid.bid_face, bid.bid_total, request)
+    except endpoints.ServiceException, e:
+        form = game.to_form('Bid rejected: %s' % e.message)
+        form.modified = False
+    raise ndb.Return(form)
+
+
+def _seated_players(game, user_key):
+    """Returns the Players a user holds in a game. Archived games rebuild
+    them from the archive."""
+    if game.archived:
+        return [player for player in game.archived_players()
+                if player.user == user_key]
+    players = ndb.get_multi([seat.player for seat in game.get_seats()
+                             if seat.user == user_key])
+    return [player for player in players if player is not None]
+
+
+def _state_message(game):
+    """Returns the GameForm message describing a game's state"""
+    if game.cancelled:
+        return 'Game has been cancelled.'
+    elif game.game_over:
+        return 'Game is over. %s won.' % (game.user_name_for(game.winner))
+    else:
+        return 'It\'s %s\'s turn!' % (game.turn_seat().user_name)
 
 
 @endpoints.api(name='liars_dice', version='v1')
@@ -56,20 +298,29 @@ class LiarsDiceApi(remote.Service):
                       http_method='POST')
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.user_name == request.user_name).get():
-            raise endpoints.ConflictException(
-                    'A User with that name already exists!')
-        user = User(
-            user_name=request.user_name,
-            email=request.email,
-            password=request.password)
-        user.put()
-        # Setup user score for high score
-        score = Score(user=user.key)
-        score.put()
+        _create_user(request.user_name, request.email, request.password)
+        try:
+            scoring.schedule_aggregation()
+        except taskqueue.Error:
+            # The signup event waits for the next aggregation instead
+            logging.warning('Could not schedule score aggregation.',
+                            exc_info=True)
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
+    @endpoints.method(request_message=LOGIN_REQUEST,
+                      response_message=SessionForm,
+                      path='login',
+                      name='login',
+                      http_method='POST')
+    def login(self, request):
+        """Checks a user's password and returns a session token to use in
+        place of the password on later requests."""
+        user_key = User.key_for(request.user_name)
+        _check_password(user_key, request.password)
+        token, expires = issue_token(user_key)
+        return SessionForm(token=token, expires=expires)
+
     @endpoints.method(request_message=NEW_GAME_REQUEST,
                       response_message=GameForm,
                       path='game',
@@ -81,48 +332,99 @@ class LiarsDiceApi(remote.Service):
         user_bucket = []
 
         for user in request.users:
-            if user in user_bucket:
+            if User.normalize(user) in user_bucket:
                 raise endpoints.BadRequestException('A user cannot be '
                                                     'represented more than '
                                                     'once.')
             else:
-                user_bucket.append(user)
-            if not User.query(User.user_name == user).get():
+                user_bucket.append(User.normalize(user))
+
+        # Resolve every seat with one batched lookup
+        users = ndb.get_multi([User.key_for(user) for user in request.users])
+        for user_name, user in zip(request.users, users):
+            if not user:
                 raise endpoints.NotFoundException(
                     'A User with the name %s does not exist!'
-                    % (user.replace("'", "''")))
+                    % (user_name.replace("'", "''")))
+
         try:
-            game = Game.new_game(request.users, request.dice_per_player,
+            game = Game.new_game(users, request.dice_per_player,
                                  request.dice_sides, request.wild)
-        except ValueError:
-            # Change for wrong number of faces
-            raise endpoints.BadRequestException('At least 1 die is needed to '
-                                                'play.')
+        except rules.RuleError, e:
+            raise endpoints.BadRequestException(e.message)
+        cache_entity(game)
         return game.to_form('Good luck playing Pirate''s Dice!')
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=POLL_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
     def get_game(self, request):
-        """Return the current game state."""
+        """Return the current game state. Pass the last seen version to find
+        out cheaply whether anything has changed."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if game:
-            if game.cancelled:
-                return game.to_form('Game has been cancelled.')
-            elif game.game_over:
-                return game.to_form('Game is over. %s won.' %
-                                    (game.winner.get().user_name))
+            if request.version is not None and request.version == game.version:
+                form = game.to_form('Game unchanged.')
+                form.modified = False
+                return form
             else:
-                bidding_player = Player.query(
-                    Player.game == game.key,
-                    Player.order == (game.bid_player) % game.players + 1).get()
-                return game.to_form('It\'s %s\'s turn!' %
-                                    (bidding_player.user.get().user_name))
+                return game.to_form(_state_message(game))
         else:
             raise endpoints.NotFoundException('Game not found!')
 
+    @endpoints.method(request_message=GET_GAMES_REQUEST,
+                      response_message=GameForms,
+                      path='games/batch',
+                      name='get_games',
+                      http_method='GET')
+    def get_games(self, request):
+        """Returns the current state of several games with one batched
+        lookup. Games that do not exist are left out."""
+        _check_batch(request.urlsafe_game_keys)
+        games = get_multi_by_urlsafe(request.urlsafe_game_keys, Game)
+        forms = GameForms()
+        forms.games = [game.to_form(_state_message(game))
+                       for game in games if game is not None]
+        return forms
+
+    @endpoints.method(request_message=GET_DASHBOARD_REQUEST,
+                      response_message=DashboardForms,
+                      path='dashboard',
+                      name='get_dashboard',
+                      http_method='GET')
+    def get_dashboard(self, request):
+        """Returns the state of several games along with the user's own
+        dice in each, reading all the games and all the user's hands in
+        one batch each. Games that do not exist are left out."""
+        _check_batch(request.urlsafe_game_keys)
+        user_key = User.key_for(request.user_name)
+        authorized = _authorize_async(request, user_key)
+        games = [game for game in
+                 get_multi_by_urlsafe(request.urlsafe_game_keys, Game)
+                 if game is not None]
+        player_keys = [[seat.player for seat in game.get_seats()
+                        if seat.user == user_key and not game.archived]
+                       for game in games]
+        players = ndb.get_multi_async(
+            [key for keys in player_keys for key in keys])
+        authorized.get_result()
+        players = dict((player.key, player)
+                       for player in [future.get_result()
+                                      for future in players]
+                       if player is not None)
+        forms = DashboardForms()
+        for game, keys in zip(games, player_keys):
+            if game.archived:
+                hands = _seated_players(game, user_key)
+            else:
+                hands = [players[key] for key in keys if key in players]
+            forms.games.append(DashboardForm(
+                game=game.to_form(_state_message(game)),
+                dice=Dice.to_form(hands).dice))
+        return forms
+
     @endpoints.method(request_message=GET_USER_GAMES_REQUEST,
                       response_message=GameForms,
                       path='games',
@@ -130,34 +432,31 @@ class LiarsDiceApi(remote.Service):
                       http_method='GET')
     def get_user_games(self, request):
         """Returns games for a specific user."""
-        user = User.query(User.user_name == request.user_name).get()
-
-        if user:
-            if user.password != request.password:
-                raise endpoints.UnauthorizedException(
-                            'Invalid password!')
-
-            user_plays = Player.query(Player.user == user.key)
-
-            if user_plays:
-                games = []
-                for play in user_plays:
-                    game = play.game.get()
-                    if not game.game_over and not game.cancelled:
-                        game_number = len(games)
-                        games.append(
-                            game.to_form('Game number %d.' % (game_number)))
-                if len(games) != 0:
-                    forms = GameForms()
-                    forms.games = games
-                    return forms
-                else:
-                    raise endpoints.NotFoundException(
-                        'No active games found.')
-            else:
-                raise endpoints.NotFoundException('No games found.')
+        user_key = User.key_for(request.user_name)
+        _authorize(request, user_key)
+
+        try:
+            cursor = Cursor(urlsafe=request.cursor) if request.cursor else None
+        except datastore_errors.BadValueError:
+            raise endpoints.BadRequestException('Invalid cursor.')
+        limit = max(1, min(request.limit, 100))
+        user_plays, next_cursor, more = (
+            Player.query(Player.user == user_key, Player.active == True)
+                  .fetch_page(limit, start_cursor=cursor, keys_only=True))
+
+        if user_plays:
+            games = get_multi_cached([play.parent() for play in user_plays])
+            # The index can briefly lag behind a game that just ended
+            games = [game for game in games if game is not None and
+                     not game.game_over and not game.cancelled]
+            forms = GameForms()
+            forms.games = [game.to_form('Game number %d.' % (game_number))
+                           for game_number, game in enumerate(games)]
+            if more and next_cursor:
+                forms.cursor = next_cursor.urlsafe()
+            return forms
         else:
-            raise endpoints.NotFoundException('User not found.')
+            raise endpoints.NotFoundException('No active games found.')
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
@@ -170,11 +469,8 @@ class LiarsDiceApi(remote.Service):
         # Maybe will add a drop feature instead someday to prevent rage quits.
         # Idea: would be a Player field
         if game:
-            if game.game_over or game.cancelled:
-                raise endpoints.ConflictException('Game already over!')
-            else:
-                game.cancelled = True
-                game.put()
+            game = _cancel_game(game.key, game.players).get_result()
+            cache_entity(game)
             return game.to_form('Game cancelled.')
         else:
             raise endpoints.NotFoundException('Game not found!')
@@ -188,209 +484,133 @@ class LiarsDiceApi(remote.Service):
         """Returns a player's dice."""
         # Can still use if game is over or cancelled for historical purposes
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        user = User.query(User.user_name == request.user_name).get()
         if game:
-            player = Player.query(
-                Player.game == game.key,
-                Player.user == user.key)
-            if user:
-                if player:
-                    if user.password != request.password:
-                        raise endpoints.UnauthorizedException(
-                            'Invalid password!')
-                    else:
-                        # For those using themselves to test
-                        ids = []
-                        for row in player:
-                            ids.append(row.key)
-                        dice = (Dice.query(Dice.player.IN(ids))
-                                    .order(Dice.player).order(Dice.face))
-                        return Dice.to_form(dice)
-                else:
-                    raise endpoints.NotFoundException('Player not found!')
+            user_key = User.key_for(request.user_name)
+            _authorize(request, user_key)
+            player = _seated_players(game, user_key)
+            if player:
+                # For those using themselves to test
+                return Dice.to_form(player)
             else:
-                raise endpoints.NotFoundException(
-                    'A User with the name %s does not exist!'
-                    % (user.replace("'", "''")))
+                raise endpoints.NotFoundException('Player not found!')
         else:
             raise endpoints.NotFoundException('Game not found!')
 
+    @endpoints.method(request_message=GET_DICE_REQUEST,
+                      response_message=OddsForm,
+                      path='odds/{urlsafe_game_key}',
+                      name='get_odds',
+                      http_method='GET')
+    def get_odds(self, request):
+        """Returns the chance that the current bid holds, counting the
+        user's own dice and the odds for the dice they cannot see."""
+        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        user_key = User.key_for(request.user_name)
+        _authorize(request, user_key)
+        players = _seated_players(game, user_key)
+        if not players:
+            raise endpoints.NotFoundException('Player not found!')
+        # For those using themselves to test, every hand they hold is known
+        hand = [0] * game.die_faces
+        for player in players:
+            for face, total in enumerate(player.get_hand()[:game.die_faces]):
+                hand[face] += total
+        known = sum(hand)
+        unknown = game.dice_total * game.players - known
+        return OddsForm(bid_face=game.bid_face,
+                        bid_total=game.bid_total,
+                        known=rules.count_face(hand, game.bid_face,
+                                               game.wild),
+                        unknown=unknown,
+                        probability=rules.bid_odds_for(
+                            hand, unknown, game.bid_face, game.bid_total,
+                            game.wild))
+
     @endpoints.method(request_message=RAISE_BID_REQUEST,
                       response_message=GameForm,
                       path='bid/{urlsafe_game_key}',
                       name='raise_bid',
                       http_method='PUT')
+    @ndb.synctasklet
     def raise_bid(self, request):
         """Makes a move. Returns a game state with message"""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        form = yield _raise_bid(game, request.bid_face, request.bid_total,
+                                request)
+        raise ndb.Return(form)
 
-        # Validity logic
-        if game.game_over or game.cancelled:
-            raise endpoints.ConflictException('Game already over!')
-
-        bidding_player = Player.query(
-            Player.game == game.key,
-            Player.order == game.bid_player % game.players + 1).get()
-
-        bidding_user = bidding_player.user.get()
-
-        if bidding_user.password != request.password:
-            raise endpoints.UnauthorizedException('Invalid password.')
-
-        if (game.bid_face == game.die_faces and
-                game.bid_total == game.dice_total * game.players):
-            raise endpoints.BadRequestException('Already at max possible bid. '
-                                                'Bid cannot be rasied. Call '
-                                                'liar to end game.')
-
-        if request.bid_face < 1 or request.bid_face > game.die_faces:
-            raise endpoints.BadRequestException('Invalid face number. Must be '
-                                                'between 1 and ' 
-                                                + str(game.die_faces) + '.')
-
-        if request.bid_face < game.bid_face:
-            raise endpoints.BadRequestException('Invalid dice face. Must be '
-                                                'greater than or equal to the '
-                                                'current dice face bid:%d.'
-                                                % (game.bid_face))
-
-        if (request.bid_face == game.bid_face and
-                request.bid_total <= game.bid_total):
-            raise endpoints.BadRequestException('Invalid bid. If not raising '
-                                                'dice face, must raise dice '
-                                                'total')
-
-        # Game logic
-        game.bid_face = request.bid_face
-        game.bid_total = request.bid_total
-        game.turn += 1
-        # Update player info
-        if game.bid_player == game.players:
-            game.bid_player = 1
-        else:
-            game.bid_player += 1
-        game.put()
-
-        # Record History
-        game_history = GameHistory(game=game.key,
-                                   turn=game.turn,
-                                   player=bidding_player.key,
-                                   bid_face=game.bid_face,
-                                   bid_total=game.bid_total)
-        game_history.put()
-
-        # Find the next player
-        next_player = Player.query(
-            Player.game == game.key,
-            Player.order == game.bid_player % game.players + 1).get()
-
-        next_user = next_player.user.get()
-
-        if next_user.email is not None:
-            task_params = ({
-                'email': next_user.email,
-                'user_name': next_user.user_name,
-                'game_key': game.key.urlsafe(),
-                'dice': Dice.query(Dice.player == next_player.key)
-                            .order(Dice.face),
-                'bid_face': game.bid_face,
-                'bid_total': game.bid_total,
-                'bid_player': bidding_user.user_name})
-
-            taskqueue.add(
-                params=task_params,
-                url='/tasks/send_your_turn'
-            )
-
-        return game.to_form('Current bid is now face: %d, number %d. It is '
-                            '%s\'s turn.' % (request.bid_face,
-                                             request.bid_total,
-                                             next_user.user_name))
+    @endpoints.method(request_message=RAISE_BIDS_REQUEST,
+                      response_message=GameForms,
+                      path='bids',
+                      name='raise_bids',
+                      http_method='PUT')
+    @ndb.synctasklet
+    def raise_bids(self, request):
+        """Makes moves in several games at once. Moves run side by side and
+        each succeeds or fails on its own, a rejected move's GameForm says
+        why in its message."""
+        urlsafe_game_keys = [bid.urlsafe_game_key for bid in request.bids]
+        _check_batch(urlsafe_game_keys)
+        games = get_multi_by_urlsafe(urlsafe_game_keys, Game)
+        results = yield [_try_raise_bid(game, bid, request)
+                         for game, bid in zip(games, request.bids)]
+        forms = GameForms()
+        forms.games = [form for form in results if form is not None]
+        raise ndb.Return(forms)
 
     @endpoints.method(request_message=CALL_LIAR_REQUEST,
                       response_message=GameForm,
                       path='liar/{urlsafe_game_key}',
                       name='call_liar',
                       http_method='PUT')
+    @ndb.synctasklet
     def call_liar(self, request):
         """Returns a player's dice."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
 
         # Validity logic
         if game.game_over or game.cancelled:
-            return game.to_form('Game already over!')
+            raise ndb.Return(game.to_form('Game already over!'))
 
         if game.turn < 1:
             raise endpoints.BadRequestException(
                 'At least one turn must pass before calling liar.')
 
         # Get players of interest
-        bidding_player = Player.query(
-            Player.game == game.key,
-            Player.order == game.bid_player).get()
-
-        bidding_user = bidding_player.user.get()
-
-        calling_player = Player.query(
-            Player.game == game.key,
-            Player.order == game.bid_player % game.players + 1).get()
-
-        calling_user = calling_player.user.get()
+        bidding_seat = game.bidding_seat()
+        calling_seat = game.turn_seat()
 
-        if calling_user.password != request.password:
-            raise endpoints.UnauthorizedException('Invalid password.')
-
-        # Game Logic
-        game.game_over = True
+        yield _authorize_async(request, calling_seat.user)
 
         # Count dice and update score
         """ Technically, players can cheat by playing against themselves.
         Ignoring validity check in the meanwhile for testing purposes. """
-        players = Player.query(Player.game == game.key)
-        ids = []
-        dice_total = 0
-        for player in players:
-            ids.append(player.key)
-            # Dice logic
-            dice = Dice.query(Dice.player.IN(ids))
-            for die in dice:
-                if die.face == game.bid_face:
-                    dice_total += die.total
+        dice_total = game.count_face(game.bid_face)
 
         message = ('For a face of %d: real total - %d, bid total - %d. ' %
                    (game.bid_face, dice_total, game.bid_total))
-        if die.total < game.bid_total:
-            winner = calling_user.key
+        if dice_total < game.bid_total:
+            winner = calling_seat.user
             message += ('%s was lying! %s wins!' %
-                        (bidding_user.user_name.replace("'", "''"),
-                         calling_user.user_name.replace("'", "''")))
+                        (bidding_seat.user_name.replace("'", "''"),
+                         calling_seat.user_name.replace("'", "''")))
         else:
-            winner = bidding_user.key
+            winner = bidding_seat.user
             message += ('%s was telling the truth! %s wins!' %
-                        (bidding_user.user_name.replace("'", "''"),
-                         bidding_user.user_name.replace("'", "''")))
-
-        game.winner = winner
-
-        # Add score to winner
-        # Prevent score for being raised if playing against self
-        if players.count() > 1:
-            for player in players:
-                # Score logic
-                # Prevent score for being raised if playing against self
-                if players.count() > 1:
-                    score_user = player.user.get()
-                    score = Score.query(Score.user == score_user.key).get()
-                    if score is not None:
-                        score.games += 1
-                    else:
-                        score = Score(user=score_user.key)
-                    if player.user == game.winner:
-                        score.wins += 1
-                        score.score += game.turn
-                    score.put()
-        game.put()
-        return game.to_form(message)
+                        (bidding_seat.user_name.replace("'", "''"),
+                         bidding_seat.user_name.replace("'", "''")))
+
+        # Game Logic
+        game = yield _end_game(game.key, game.players, game.turn, winner)
+        yield cache_entity_async(game)
+
+        # Scores are added to the winner and players by a task queued when
+        # the game ended. Games against oneself do not count.
+        raise ndb.Return(game.to_form(message))
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameHistoryForms,
@@ -401,34 +621,59 @@ class LiarsDiceApi(remote.Service):
         """Returns the move history for a specified game."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if game:
-            game_history = (GameHistory.query(GameHistory.game == game.key)
-                                       .order(GameHistory.turn))
-            if game_history:
-                return GameHistory.to_form(game_history)
+            if game.archived:
+                buckets = game.archived_buckets()
+            else:
+                buckets = [bucket for bucket in
+                           ndb.get_multi(GameHistoryBucket.keys_for(game))
+                           if bucket is not None]
+            if buckets:
+                return GameHistoryBucket.to_form(game, buckets)
+            elif game.turn > 0 and not game.archived:
+                # Played before bids were packed into buckets
+                return GameHistory.to_form(
+                    GameHistory.query(ancestor=game.key)
+                               .order(GameHistory.turn))
             else:
                 raise endpoints.NotFoundException(
                     'No bids have been raised for this game yet')
         else:
             raise endpoints.NotFoundException('Game not found!')
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=RANKINGS_REQUEST,
+                      response_message=ScoreForms,
                       path='rank',
                       name='get_user_rankings',
                       http_method='GET')
     def get_user_rankings(self, request):
-        """Returns all players and their ranks."""
-        # Create Score Forms
-        # Can order app engine request
-        scores = Score.query().order(-Score.score)
-        forms = ScoreForms()
-        forms.scores = []
-        rank = 1
-        if scores.count() > 0:
-            for score in scores:
-                forms.scores.append(score.to_form(rank))
-                rank += 1
+        """Returns a page of players and their ranks. Pass the cursor from
+        a page to get the next one."""
+        try:
+            forms = leaderboard.get_page(request.cursor, request.limit)
+        except ValueError:
+            raise endpoints.BadRequestException('Invalid cursor.')
+        if forms.scores:
             return forms
         else:
             raise endpoints.NotFoundException('No scores recorded yet!')
 
-api = endpoints.api_server([LiarsDiceApi])
+    @endpoints.method(request_message=USER_RANK_REQUEST,
+                      response_message=ScoreForms,
+                      path='rank/{user_name}',
+                      name='get_user_rank',
+                      http_method='GET')
+    def get_user_rank(self, request):
+        """Returns a user's rank along with the players ranked around
+        them."""
+        user_key = User.key_for(request.user_name)
+        score, user = ndb.get_multi([Score.key_for(user_key), user_key])
+        if not score and user:
+            # Signed up since scores were last aggregated
+            score = Score(key=Score.key_for(user_key), user=user_key,
+                          user_name=user.user_name)
+        if score:
+            return leaderboard.get_rank(score, request.neighbours)
+        else:
+            raise endpoints.NotFoundException('User not found.')
+
+api = instrumentation.wrap(endpoints.api_server([LiarsDiceApi]))
@@ -0,0 +1,107 @@
+"""archive.py - Compacts ended games. Once a game is over or cancelled its
+hands and bid history never change, so they are packed into a compressed
+archive on the Game itself and the Player, GameHistoryBucket and legacy Dice
+and GameHistory rows beneath it are deleted. Readers check Game.archived and
+rebuild those entities from the archive, so archived games are still served
+by the same endpoints."""
+
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Game, GameHistory, GameHistoryBucket, Dice
+from utils import cache_entity
+
+ARCHIVE_GAMES_URL = '/tasks/archive_games'
+ARCHIVE_BATCH_SIZE = 50
+DELETE_BATCH_SIZE = 500
+
+
+def queue_archive(cursor=None):
+    """Queues archiving the next batch of ended games"""
+    params = {}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    taskqueue.add(url=ARCHIVE_GAMES_URL, params=params)
+
+
+def archive_batch(urlsafe_cursor=None):
+    """Archives one batch of ended games and queues the next"""
+    cursor = Cursor(urlsafe=urlsafe_cursor) if urlsafe_cursor else None
+    game_keys, next_cursor, more = (
+        Game.query(Game.finished == True, Game.archived == False)
+            .fetch_page(ARCHIVE_BATCH_SIZE, start_cursor=cursor,
+                        keys_only=True))
+    for game_key in game_keys:
+        archive_game(game_key)
+    if more and next_cursor:
+        queue_archive(next_cursor)
+    else:
+        logging.info('Archiving finished.')
+
+
+def _read_game(game):
+    """Returns the archive for a game and the keys it replaces"""
+    seats = game.get_seats()
+    players = ndb.get_multi([seat.player for seat in seats])
+    hands = []
+    dice_keys = []
+    for player in players:
+        hand = player.get_hand() if player else []
+        hands.append(hand + [0] * (game.die_faces - len(hand)))
+        if player and not player.hand:
+            dice_keys.extend(Dice.query(Dice.player == player.key)
+                             .fetch(keys_only=True))
+    buckets = [[bucket.first_turn, bucket.turns] for bucket in
+               ndb.get_multi(GameHistoryBucket.keys_for(game)) if bucket]
+    # Bids made before history was packed into buckets
+    orders = dict((seat.player, order)
+                  for order, seat in enumerate(seats, 1))
+    for turn in (GameHistory.query(ancestor=game.key)
+                            .order(GameHistory.turn)):
+        if turn.player not in orders:
+            logging.warning('Leaving turn %d out of the archive of game %s, '
+                            'its player %s is not in the game.', turn.turn,
+                            game.key.urlsafe(), turn.player)
+            continue
+        buckets.append([turn.turn, [orders[turn.player], turn.bid_face,
+                                    turn.bid_total]])
+    buckets.sort()
+    return {'hands': hands, 'buckets': buckets}, seats, dice_keys
+
+
+@ndb.transactional
+def _store_archive(game_key, version, archive, seats):
+    game = game_key.get()
+    if game.archived or game.version != version:
+        return None
+    game.seats = seats
+    if not game.histogram:
+        game.histogram = [sum(counts) for counts in zip(*archive['hands'])]
+    game.archive = archive
+    game.archived = True
+    game.version += 1
+    game.put()
+    return game
+
+
+def archive_game(game_key):
+    """Archives an ended game and deletes the rows the archive replaces.
+    Safe to run again, a game already archived is left alone."""
+    game = game_key.get()
+    if not game or game.archived or not game.finished:
+        return
+    archive, seats, dice_keys = _read_game(game)
+    game = _store_archive(game_key, game.version, archive, seats)
+    if game is None:
+        # Changed while being read, the next run picks it up again
+        return
+    cache_entity(game)
+    # Everything beneath the game is now in the archive
+    stale_keys = [key for key in
+                  ndb.Query(ancestor=game_key).iter(keys_only=True)
+                  if key != game_key] + dice_keys
+    for start in range(0, len(stale_keys), DELETE_BATCH_SIZE):
+        ndb.delete_multi(stale_keys[start:start + DELETE_BATCH_SIZE])
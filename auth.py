@@ -0,0 +1,61 @@
+"""auth.py - Signed, expiring session tokens. A token names a user and is
+signed with a per-application secret, so endpoints can check who is making a
+move without reading the User entity or comparing passwords."""
+
+import base64
+import hashlib
+import hmac
+import os
+import time
+
+from models import SessionSecret
+
+# How long a session token is valid for, in seconds
+SESSION_TIME = int(os.environ.get('SESSION_TIME', 24 * 60 * 60))
+
+# The signing secret is loaded once per instance
+_secret = None
+
+
+def _get_secret():
+    global _secret
+    if _secret is None:
+        _secret = SessionSecret.get_or_insert(
+            'session', secret=os.urandom(32)).secret
+    return _secret
+
+
+def _sign(payload):
+    return hmac.new(_get_secret(), payload, hashlib.sha256).hexdigest()
+
+
+def token_user_id(user_key):
+    """Returns a user's key id as it is written in their tokens, a UTF-8
+    encoded string"""
+    return unicode(user_key.id()).encode('utf-8')
+
+
+def issue_token(user_key):
+    """Returns a session token for the user and when it expires, as seconds
+    since the epoch"""
+    expires = int(time.time()) + SESSION_TIME
+    payload = '{}:{}'.format(token_user_id(user_key), expires)
+    token = '{}:{}'.format(payload, _sign(payload))
+    return base64.urlsafe_b64encode(token), expires
+
+
+def verify_token(token):
+    """Returns the key id, as given by token_user_id, of the user a valid,
+    unexpired token was issued to, or None"""
+    try:
+        payload, signature = (base64.urlsafe_b64decode(str(token))
+                              .rsplit(':', 1))
+        user_id, expires = payload.rsplit(':', 1)
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return None
+    if not hmac.compare_digest(_sign(payload), signature):
+        return None
+    if expires < time.time():
+        return None
+    return user_id
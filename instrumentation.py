@@ -0,0 +1,145 @@
+"""instrumentation.py - Counts the API calls and time each request spends.
+
+Every RPC an instance makes to an App Engine service (datastore, memcache,
+taskqueue, mail...) passes through apiproxy hooks installed here. While a
+sampled request is running the hooks count its calls and payload bytes by
+service and method. When it finishes a one line JSON summary is logged and
+the totals are folded into this instance's per route counters, which the
+admin stats handler reports."""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+# Fraction of requests to instrument, 0 turns instrumentation off
+SAMPLE_RATE = float(os.environ.get('STATS_SAMPLE_RATE', 1.0))
+
+_local = threading.local()
+_lock = threading.Lock()
+# Per route totals for this instance
+ROUTE_STATS = {}
+# Callables given each finished request's summary
+_listeners = []
+
+
+class RequestStats(object):
+    """API calls made while serving one request"""
+
+    def __init__(self, route):
+        self.route = route
+        self.start = time.time()
+        self.calls = {}
+        self.request_bytes = 0
+        self.response_bytes = 0
+
+    def record(self, service, call, request, response):
+        name = '{}.{}'.format(service, call)
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.request_bytes += _byte_size(request)
+        self.response_bytes += _byte_size(response)
+
+    def to_dict(self):
+        return {'route': self.route,
+                'ms': int((time.time() - self.start) * 1000),
+                'rpcs': sum(self.calls.values()),
+                'calls': self.calls,
+                'request_bytes': self.request_bytes,
+                'response_bytes': self.response_bytes}
+
+
+def _byte_size(message):
+    try:
+        return message.ByteSize()
+    except Exception:
+        return 0
+
+
+def _post_call_hook(service, call, request, response):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.record(service, call, request, response)
+
+
+def start(route):
+    """Starts counting the current request's calls if it is sampled"""
+    if SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE:
+        _local.stats = RequestStats(route)
+    else:
+        _local.stats = None
+
+
+def finish():
+    """Stops counting the current request's calls, logs them and adds them
+    to the route totals"""
+    stats = getattr(_local, 'stats', None)
+    _local.stats = None
+    if stats is None:
+        return
+    summary = stats.to_dict()
+    logging.info('stats %s', json.dumps(summary, sort_keys=True))
+    for listener in _listeners:
+        listener(summary)
+    with _lock:
+        totals = ROUTE_STATS.setdefault(stats.route, {
+            'requests': 0, 'ms': 0, 'max_ms': 0, 'rpcs': 0, 'calls': {},
+            'request_bytes': 0, 'response_bytes': 0})
+        totals['requests'] += 1
+        totals['ms'] += summary['ms']
+        totals['max_ms'] = max(totals['max_ms'], summary['ms'])
+        totals['rpcs'] += summary['rpcs']
+        totals['request_bytes'] += summary['request_bytes']
+        totals['response_bytes'] += summary['response_bytes']
+        for name, count in stats.calls.items():
+            totals['calls'][name] = totals['calls'].get(name, 0) + count
+
+
+def add_listener(listener):
+    """Calls listener with the summary of every instrumented request as it
+    finishes"""
+    _listeners.append(listener)
+
+
+def current():
+    """Returns the current request's call counts so far, or None if it is
+    not being sampled"""
+    stats = getattr(_local, 'stats', None)
+    return stats.to_dict() if stats is not None else None
+
+
+def route_stats():
+    """Returns a copy of this instance's per route totals"""
+    with _lock:
+        return json.loads(json.dumps(ROUTE_STATS))
+
+
+def reset():
+    """Clears this instance's per route totals"""
+    with _lock:
+        ROUTE_STATS.clear()
+
+
+def wrap(app):
+    """Wraps a WSGI application so each request it serves is instrumented
+    under its path. Endpoints requests arrive as /_ah/spi/Service.method,
+    so every API method gets a route of its own."""
+    def instrumented(environ, start_response):
+        start(environ.get('PATH_INFO', ''))
+        try:
+            return app(environ, start_response)
+        finally:
+            finish()
+    return instrumented
+
+
+def install():
+    """Registers the call hook, once per instance"""
+    hooks = apiproxy_stub_map.apiproxy.GetPostCallHooks()
+    hooks.Append('instrumentation', _post_call_hook)
+
+
+install()
@@ -0,0 +1,168 @@
+"""leaderboard.py - Paged, cached leaderboard snapshots. Each page is read
+with a Datastore cursor, so serving one costs the same however many users
+there are, and rendered pages are kept in memcache until scores change.
+A histogram of scores lets a single user's rank be found without paging."""
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Score, ScoreEvent, ScoreForm, ScoreForms, ScoreHistogram
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# How long a rendered page may be served from memcache, in seconds
+PAGE_CACHE_TIME = 5 * 60
+_GENERATION_KEY = 'leaderboard:generation'
+
+
+def _generation():
+    generation = memcache.get(_GENERATION_KEY)
+    if generation is None:
+        memcache.add(_GENERATION_KEY, 0)
+        generation = 0
+    return generation
+
+
+HISTOGRAM_ID = 'scores'
+NEIGHBOURS = 2
+MAX_NEIGHBOURS = 10
+COUNT_BATCH_SIZE = 200
+COUNT_EVENTS_PER_TRANSACTION = 24
+
+
+def _count_change(counts, old_score, new_score):
+    """Moves one user between buckets of counts. A bucket may go negative
+    while a decrement waits for the increment it overtook, so only an
+    empty bucket is removed."""
+    if old_score == new_score:
+        return
+    for bucket, step in ((old_score, -1), (new_score, 1)):
+        if bucket is None:
+            continue
+        bucket = str(bucket)
+        counts[bucket] = counts.get(bucket, 0) + step
+        if counts[bucket] == 0:
+            del counts[bucket]
+
+
+@ndb.transactional
+def _update_histogram(changes):
+    histogram = ScoreHistogram.get_or_insert(HISTOGRAM_ID)
+    if histogram.counts is None:
+        histogram.counts = {}
+    for old_score, new_score in changes:
+        _count_change(histogram.counts, old_score, new_score)
+    histogram.put()
+
+
+@ndb.transactional(xg=True)
+def _count_events(event_keys):
+    """Counts the pending Score changes of events in the histogram and
+    clears them, so an event is only ever counted once"""
+    entities = ndb.get_multi([ndb.Key(ScoreHistogram, HISTOGRAM_ID)] +
+                             event_keys)
+    histogram = entities[0] or ScoreHistogram(id=HISTOGRAM_ID)
+    if histogram.counts is None:
+        histogram.counts = {}
+    counted = []
+    for event in entities[1:]:
+        if event is None or not event.histogram_pending:
+            continue
+        _count_change(histogram.counts, event.histogram_from,
+                      event.histogram_to)
+        event.histogram_pending = False
+        counted.append(event)
+    if counted:
+        ndb.put_multi([histogram] + counted)
+
+
+def scores_changed(changes=()):
+    """Records score changes, given as (old score, new score) pairs with an
+    old score of None for new users, in the histogram. Marks every cached
+    page as stale; pages are rebuilt one at a time as they are next asked
+    for."""
+    changes = [(old, new) for old, new in changes if old != new]
+    if changes:
+        _update_histogram(changes)
+    memcache.incr(_GENERATION_KEY, initial_value=0)
+
+
+def count_score_events(event_keys):
+    """Counts the Score changes recorded on ScoreEvents in the histogram,
+    along with any left pending by an earlier run that failed part way.
+    Returns True if more may be waiting."""
+    pending = (ScoreEvent.query(ScoreEvent.histogram_pending == True)
+                         .fetch(COUNT_BATCH_SIZE, keys_only=True))
+    event_keys = list(set(event_keys) | set(pending))
+    # The histogram and its events share one cross-group transaction, which
+    # may span at most 25 entity groups
+    for start in range(0, len(event_keys), COUNT_EVENTS_PER_TRANSACTION):
+        _count_events(
+            event_keys[start:start + COUNT_EVENTS_PER_TRANSACTION])
+    return len(pending) == COUNT_BATCH_SIZE
+
+
+def get_rank(score, neighbours=NEIGHBOURS):
+    """Returns ScoreForms for a user's Score and up to neighbours users
+    ranked either side of them. Ranks are worked out from the histogram, so
+    tied users share a rank."""
+    neighbours = max(0, min(neighbours, MAX_NEIGHBOURS))
+    histogram = (ndb.Key(ScoreHistogram, HISTOGRAM_ID).get() or
+                 ScoreHistogram(id=HISTOGRAM_ID))
+    above, below = [], []
+    if neighbours:
+        above = Score.query(Score.score > score.score).order(
+            Score.score).fetch_async(neighbours)
+        below = Score.query(Score.score < score.score).order(
+            -Score.score).fetch_async(neighbours)
+        above = list(reversed(above.get_result()))
+        below = below.get_result()
+    forms = ScoreForms()
+    forms.scores = [row.to_form(histogram.users_above(row.score) + 1)
+                    for row in above + [score] + below]
+    return forms
+
+
+def _parse_page_token(page_token):
+    """Splits a page token into the rank of its first row and a Cursor"""
+    if not page_token:
+        return 1, None
+    try:
+        rank, cursor = page_token.split(':', 1)
+        return int(rank), Cursor(urlsafe=cursor)
+    except (ValueError, datastore_errors.BadValueError):
+        raise ValueError('Invalid page token.')
+
+
+def _build_page(page_token, limit):
+    rank, cursor = _parse_page_token(page_token)
+    scores, next_cursor, more = Score.query().order(-Score.score).fetch_page(
+        limit, start_cursor=cursor)
+    rows = [(rank + offset, score.get_user_name(), score.games, score.wins,
+             score.score)
+            for offset, score in enumerate(scores)]
+    next_token = None
+    if more and next_cursor:
+        next_token = '{}:{}'.format(rank + len(scores), next_cursor.urlsafe())
+    return rows, next_token
+
+
+def get_page(page_token=None, limit=PAGE_SIZE):
+    """Returns a ScoreForms page starting at page_token, the cursor of a
+    previous page, or at the top of the leaderboard"""
+    limit = max(1, min(limit or PAGE_SIZE, MAX_PAGE_SIZE))
+    cache_key = 'leaderboard:{}:{}:{}'.format(_generation(), limit,
+                                              page_token or '')
+    page = memcache.get(cache_key)
+    if page is None:
+        page = _build_page(page_token, limit)
+        memcache.set(cache_key, page, time=PAGE_CACHE_TIME)
+    rows, next_token = page
+    forms = ScoreForms()
+    forms.scores = [ScoreForm(rank=rank, user_name=user_name, games=games,
+                              wins=wins, score=score)
+                    for rank, user_name, games, wins, score in rows]
+    forms.cursor = next_token
+    return forms
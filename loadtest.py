@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+
+"""loadtest.py - Drives the game API against the App Engine SDK's in-memory
+service stubs and reports how each endpoint performs.
+
+Run it offline with the SDK's Python 2.7 interpreter, for example:
+
+    python loadtest.py --sdk ~/google_appengine --users 200 --games 100
+
+The workload creates and logs in users, starts games between them and plays
+them out turn by turn, interleaving every game so their moves land side by
+side. Players poll and read their dice between moves, and the last player
+calls liar. Along the way users read their games, the leaderboard and their
+rank. Every migration runs over the new games and a game stored the legacy
+way. Queued tasks (turn notifications, score recording and aggregation) run
+between rounds. At the end the reminder, sweep and archive crons run and
+archived games are read back.
+
+The datastore stub requires indexes, so any query in the API, the tasks or
+the migrations that needs a composite index missing from index.yaml fails
+the run. A small run doubles as the
+index check:
+
+    python loadtest.py --sdk ~/google_appengine --users 4 --games 2
+
+Each call is counted by instrumentation.py, so the report lists latency
+percentiles and the average number of datastore, memcache and task queue
+calls per endpoint. Latencies against the stubs are not production numbers,
+but the call counts are, and comparing both between two revisions of api.py
+or models.py shows regressions before they are deployed."""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'loadtest'
+SPI = '/_ah/spi/LiarsDiceApi.'
+
+
+def _setup_sdk(sdk_path):
+    """Puts the SDK and its bundled libraries on the path"""
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+
+def _activate_testbed():
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id='piratesdicegame')
+    # Queries needing a composite index missing from index.yaml raise
+    # NeedIndexError instead of quietly adding it
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.
+        PseudoRandomHRConsistencyPolicy(probability=1),
+        require_indexes=True, root_path=ROOT)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    bed.init_mail_stub()
+    bed.init_app_identity_stub()
+    return bed
+
+
+class Harness(object):
+    """Issues API calls and tasks, recording each one's summary"""
+
+    def __init__(self, bed):
+        import webapp2
+        from google.appengine.ext import ndb
+        from google.appengine.ext import testbed
+        import api
+        import instrumentation
+        import main
+        import migrations
+
+        self.ndb = ndb
+        self.webapp2 = webapp2
+        self.api = api
+        self.main = main
+        self.migrations = migrations
+        self.service = api.LiarsDiceApi()
+        self.taskqueue = bed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        self.instrumentation = instrumentation
+        self.samples = {}
+        self.errors = {}
+
+        # The testbed swaps in its own stubs, hook them and count everything
+        instrumentation.install()
+        instrumentation.SAMPLE_RATE = 1.0
+        instrumentation.add_listener(self._record)
+
+    def _record(self, summary):
+        self.samples.setdefault(summary['route'], []).append(summary)
+
+    def call(self, method, container, **fields):
+        """Calls an API method as a fresh request. Returns its response, or
+        None if it raised an endpoints error."""
+        import endpoints
+        request = container.combined_message_class(**fields)
+        # Each request starts with an empty in-context cache
+        self.ndb.get_context().clear_cache()
+        self.instrumentation.start(SPI + method)
+        try:
+            return getattr(self.service, method)(request)
+        except endpoints.ServiceException, e:
+            self.errors[method] = self.errors.get(method, 0) + 1
+            if self.errors[method] == 1:
+                print >> sys.stderr, '{} failed: {}'.format(method, e)
+            return None
+        finally:
+            self.instrumentation.finish()
+
+    def _app_for(self, url):
+        if url.startswith('/admin/migrate/'):
+            return self.migrations.app
+        return self.main.app
+
+    def get(self, url):
+        request = self.webapp2.Request.blank(url)
+        self.ndb.get_context().clear_cache()
+        return request.get_response(self._app_for(url))
+
+    def run_tasks(self, limit=10000):
+        """Runs queued tasks, and the tasks they queue, until none are left.
+        ETAs are ignored so coalesced notifications go out straight away."""
+        ran = 0
+        while ran < limit:
+            tasks = [(queue['name'], task)
+                     for queue in self.taskqueue.GetQueues()
+                     for task in self.taskqueue.get_filtered_tasks(
+                         queue_names=[queue['name']])]
+            if not tasks:
+                break
+            for queue_name, task in tasks:
+                self.taskqueue.DeleteTask(queue_name, task.name)
+                request = self.webapp2.Request.blank(task.url)
+                request.method = task.method
+                request.body = task.payload or ''
+                request.content_type = 'application/x-www-form-urlencoded'
+                self.ndb.get_context().clear_cache()
+                request.get_response(self._app_for(task.url))
+                ran += 1
+        return ran
+
+
+def _turn(harness, game_key):
+    """Returns the name of the user whose turn it is, read outside of any
+    instrumented request"""
+    game = harness.ndb.Key(urlsafe=game_key).get(use_cache=False)
+    return game.turn_seat().user_name
+
+
+def _seed_legacy(harness, name):
+    """Writes a game the way the first version of the app stored it: a
+    numerically keyed User, root Player, Dice and GameHistory rows and no
+    seat table. Running the migrations over it exercises their queries."""
+    from models import User, Game, Player, Dice, GameHistory, Score
+    ndb = harness.ndb
+    user = User(user_name='legacy', email='legacy@example.com',
+                password=PASSWORD)
+    user.put()
+    Score(user=user.key).put()
+    game = Game(players=2, die_faces=6, dice_total=1, wild=1, turn=1,
+                bid_player=1, bid_face=2, bid_total=1)
+    game.put()
+    players = [Player(game=game.key, user=user_key, order=order)
+               for order, user_key in enumerate(
+                   [user.key, User.key_for(name)], 1)]
+    ndb.put_multi(players)
+    ndb.put_multi([Dice(player=player.key, face=order, total=1)
+                   for order, player in enumerate(players, 1)])
+    GameHistory(game=game.key, turn=1, player=players[0].key, bid_face=2,
+                bid_total=1).put()
+
+
+def run(args):
+    bed = _activate_testbed()
+    harness = Harness(bed)
+    api = harness.api
+    rand = random.Random(args.seed)
+    started = time.time()
+
+    # Users
+    names = ['player{}'.format(i) for i in range(args.users)]
+    for name in names:
+        harness.call('create_user', api.USER_REQUEST, user_name=name,
+                     email='{}@example.com'.format(name), password=PASSWORD)
+    tokens = {}
+    for name in names:
+        session = harness.call('login', api.LOGIN_REQUEST, user_name=name,
+                               password=PASSWORD)
+        tokens[name] = session.token
+    harness.run_tasks()
+
+    # Games
+    games = {}
+    seated = {}
+    for i in range(args.games):
+        users = rand.sample(names, args.players)
+        form = harness.call('new_game', api.NEW_GAME_REQUEST, users=users,
+                            dice_per_player=args.dice,
+                            dice_sides=args.faces, wild=1)
+        games[form.urlsafe_key] = form
+        seated[form.urlsafe_key] = users
+
+    # Every migration, in the order they were deployed, over the new games
+    # and a legacy one
+    _seed_legacy(harness, names[0])
+    for migration in harness.migrations.MIGRATIONS:
+        harness.get(migration.url)
+        harness.run_tasks()
+
+    # Play every game a turn at a time, side by side
+    while games:
+        for game_key, form in games.items():
+            name = _turn(harness, game_key)
+            token = tokens[name]
+            polled = harness.call('get_game', api.POLL_GAME_REQUEST,
+                                  urlsafe_game_key=game_key,
+                                  version=form.version)
+            harness.call('get_dice', api.GET_DICE_REQUEST,
+                         urlsafe_game_key=game_key, user_name=name,
+                         token=token)
+            if polled and polled.modified:
+                form = polled
+            most = form.dice_total * form.players
+            if form.turn >= args.turns or form.bid_total >= most:
+                harness.call('call_liar', api.CALL_LIAR_REQUEST,
+                             urlsafe_game_key=game_key, token=token)
+                del games[game_key]
+                continue
+            face = max(form.bid_face or 1, 1)
+            if rand.random() < 0.3 and face < form.die_faces:
+                face, total = face + 1, 1
+            else:
+                total = (form.bid_total or 0) + 1
+            result = harness.call('raise_bid', api.RAISE_BID_REQUEST,
+                                  urlsafe_game_key=game_key, bid_face=face,
+                                  bid_total=total, token=token)
+            games[game_key] = result or form
+        harness.run_tasks()
+
+    # Reads between games
+    for name in rand.sample(names, min(args.reads, len(names))):
+        page = harness.call('get_user_games', api.GET_USER_GAMES_REQUEST,
+                            user_name=name, token=tokens[name])
+        if page and page.games:
+            keys = [game.urlsafe_key for game in page.games]
+            harness.call('get_games', api.GET_GAMES_REQUEST,
+                         urlsafe_game_keys=keys)
+            harness.call('get_game_history', api.GET_GAME_REQUEST,
+                         urlsafe_game_key=keys[0])
+        harness.call('get_user_rank', api.USER_RANK_REQUEST, user_name=name)
+    cursor = None
+    for i in range(args.reads):
+        page = harness.call('get_user_rankings', api.RANKINGS_REQUEST,
+                            cursor=cursor)
+        cursor = page.cursor if page else None
+        if not cursor:
+            break
+    harness.run_tasks()
+
+    # Crons
+    for cron in ('/crons/send_reminder', '/crons/sweep_games',
+                 '/crons/archive_games'):
+        harness.get(cron)
+        harness.run_tasks()
+
+    # Archived games are read back from their archives
+    for game_key in rand.sample(list(seated), min(args.reads, len(seated))):
+        name = seated[game_key][0]
+        harness.call('get_dice', api.GET_DICE_REQUEST,
+                     urlsafe_game_key=game_key, user_name=name,
+                     token=tokens[name])
+        harness.call('get_game_history', api.GET_GAME_REQUEST,
+                     urlsafe_game_key=game_key)
+
+    report(harness, time.time() - started)
+    bed.deactivate()
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(harness, elapsed):
+    """Prints one row per route, then the average calls each one makes"""
+    print '{:<44} {:>6} {:>6} {:>6} {:>6} {:>6} {:>6} {:>5}'.format(
+        'route', 'count', 'p50', 'p90', 'p99', 'max', 'rpcs', 'errs')
+    for route in sorted(harness.samples):
+        samples = harness.samples[route]
+        ms = [sample['ms'] for sample in samples]
+        rpcs = sum(sample['rpcs'] for sample in samples)
+        method = route[len(SPI):] if route.startswith(SPI) else route
+        print '{:<44} {:>6} {:>6} {:>6} {:>6} {:>6} {:>6.1f} {:>5}'.format(
+            route, len(samples), _percentile(ms, 0.5), _percentile(ms, 0.9),
+            _percentile(ms, 0.99), max(ms), float(rpcs) / len(samples),
+            harness.errors.get(method, 0))
+    print
+    print 'Average calls per request'
+    for route in sorted(harness.samples):
+        samples = harness.samples[route]
+        calls = {}
+        for sample in samples:
+            for name, count in sample['calls'].items():
+                calls[name] = calls.get(name, 0) + count
+        print route
+        for name in sorted(calls):
+            print '    {:<40} {:>8.2f}'.format(
+                name, float(calls[name]) / len(samples))
+    print
+    print 'Finished in {:.1f}s'.format(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='App Engine Python SDK directory')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--games', type=int, default=50)
+    parser.add_argument('--players', type=int, default=3,
+                        help='Players in each game')
+    parser.add_argument('--dice', type=int, default=5,
+                        help='Dice each player rolls')
+    parser.add_argument('--faces', type=int, default=6)
+    parser.add_argument('--turns', type=int, default=12,
+                        help='Bids made before liar is called')
+    parser.add_argument('--reads', type=int, default=20,
+                        help='Users who read their games and rank')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if not args.sdk:
+        parser.error('Pass --sdk or set APPENGINE_SDK')
+    if args.players > args.users:
+        parser.error('--players cannot exceed --users')
+    _setup_sdk(args.sdk)
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
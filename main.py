@@ -3,73 +3,169 @@
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
 
+import json
+from datetime import date
+
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import mail, app_identity, memcache, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from api import LiarsDiceApi
 
-from models import User, Game, Player
+from models import User, Game
+from utils import cache_stats
+import archive
+import instrumentation
+import notifications
+import scoring
+import sweeper
+
+REMINDER_BATCH_SIZE = 100
 
 
 class SendYourTurnEmail(webapp2.RequestHandler):
     def post(self):
-        """Send a turn notification email to a user about the game.
-        Called when a user completes a turn"""
-        app_id = app_identity.get_application_id()
-        subject = 'It''s your turn on Liar\'s Dice.'
-        body = (
-            'Hello {}, your opponent is waiting for your action in game {}.'
-            .format(
-                self.request.get('user_name'),
-                self.request.get('game_key')))
-        body += (
-            "\n\n{} raised the bid to face: {}, total: {}. Is it a lie?"
-            .format(
-                self.request.get('bid_player'),
-                self.request.get('bid_face'),
-                self.request.get('bid_total')))
-        # This will send test emails, the arguments to send_mail are:
-        # from, to, subject, body
-        mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                       self.request.get('email'),
-                       subject,
-                       body)
+        """Send a turn notification email to a user about their games.
+        Called a short while after a user completes a turn"""
+        notifications.send_turn_email(
+            ndb.Key(urlsafe=self.request.get('user_key')))
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
-        """Send a reminder email to each User with an email about games.
-        Called every 24 hours using a cron job"""
+        """Start sending a reminder email to each User with an email about
+        games waiting on them. Called every 24 hours using a cron job"""
+        run = date.today().isoformat()
+        _queue_reminders(run, 0)
+
+
+def _queue_reminders(run, batch, cursor=None):
+    """Queues one batch of a reminder run. Tasks are named after the run
+    and batch number, so a retried batch never queues its successor twice."""
+    params = {'run': run, 'batch': batch}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    try:
+        taskqueue.add(url='/tasks/send_reminders',
+                      name='reminders-{}-{}'.format(run, batch),
+                      params=params)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+    def post(self):
+        """Send reminders to one cursor-sized batch of Users with an email
+        and queue the next batch. Called from the reminder cron"""
         app_id = app_identity.get_application_id()
-        # Step 1: Find all userrs
-        users = User.query(User.email != None)
-        for user in users:
-            games = []
-            # Step 2: Find player instances of that user
-            player_instances = Player.query(Player.user == user.key)
-            # Step 3: For each player intance find out if game is active
-            # and if it's user's turn
-            for player in player_instances:
-                game = player.game.get()
-                if (not game.game_over and not game.cancelled and 
-                    (game.bid_player % game.players + 1 == player.order)):
-                        games.append(game.key.urlsafe())
-            if len(games) > 0:
-                subject = 'Liar\'s Dice Reminder!'
-                body = ('Hello {}, your opponents are waiting for you.'
-                        .format(user.user_name))
-                body += ('\nHere are your active games:')
-                for game in games:
-                    body += ('\n{}').format(game)
-                body += ('\n\nYour password: {}').format(user.password)
-                # This will send test emails, the arguments to send_mail are:
-                # from, to, subject, body
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               user.email,
-                               subject,
-                               body)
-
-
-app = webapp2.WSGIApplication([
+        run = self.request.get('run')
+        batch = int(self.request.get('batch'))
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = Cursor(urlsafe=self.request.get('cursor'))
+        # Step 1: Find a batch of users
+        users, next_cursor, more = (
+            User.query(User.email != None,
+                       projection=[User.email, User.user_name])
+                .fetch_page(REMINDER_BATCH_SIZE, start_cursor=cursor))
+        if more and next_cursor:
+            _queue_reminders(run, batch + 1, next_cursor)
+        # Step 2: Find the active games waiting on each of them at once
+        waiting = [Game.query(Game.turn_user == user.key)
+                       .fetch_async(keys_only=True)
+                   for user in users]
+        for user, games in zip(users, waiting):
+            games = games.get_result()
+            # Skip users already reminded if this batch is being retried
+            reminded_key = 'reminded:{}:{}'.format(run, user.key.id())
+            if not games or memcache.get(reminded_key):
+                continue
+            subject = 'Liar\'s Dice Reminder!'
+            body = ('Hello {}, your opponents are waiting for you.'
+                    .format(user.user_name))
+            body += ('\nHere are your active games:')
+            for game in games:
+                body += ('\n{}').format(game.urlsafe())
+            # This will send test emails, the arguments to send_mail are:
+            # from, to, subject, body
+            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                           user.email,
+                           subject,
+                           body)
+            # Marked only once sent, so a failed send is retried with the
+            # batch
+            memcache.set(reminded_key, True, time=24 * 60 * 60)
+
+
+class RecordScores(webapp2.RequestHandler):
+    def post(self):
+        """Record the score events of a finished game.
+        Called when a game ends"""
+        # Read past the entity cache, which may not have the ended game yet
+        game = ndb.Key(urlsafe=self.request.get('game_key')).get()
+        if game and game.game_over:
+            scoring.record_game_scores(game)
+
+
+class AggregateScores(webapp2.RequestHandler):
+    def post(self):
+        """Fold pending score events into user Scores.
+        Called shortly after games end"""
+        if scoring.aggregate_scores():
+            scoring.schedule_aggregation()
+
+
+class ArchiveGames(webapp2.RequestHandler):
+    def get(self):
+        """Start archiving ended games. Called every hour using a cron job"""
+        archive.queue_archive()
+
+
+class ArchiveGamesBatch(webapp2.RequestHandler):
+    def post(self):
+        """Archive one batch of ended games and queue the next.
+        Called from the archive cron"""
+        archive.archive_batch(self.request.get('cursor'))
+
+
+class SweepGames(webapp2.RequestHandler):
+    def get(self):
+        """Start timing out abandoned games. Called every hour using a cron
+        job"""
+        sweeper.start_sweep()
+
+
+class SweepGamesBatch(webapp2.RequestHandler):
+    def post(self):
+        """Time out one batch of abandoned games and queue the next.
+        Called from the sweep cron"""
+        sweeper.sweep_batch(self.request.get('cutoff'),
+                            self.request.get('cursor'))
+
+
+class Stats(webapp2.RequestHandler):
+    def get(self):
+        """Report this instance's per route call counts and cache counters"""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+            'sample_rate': instrumentation.SAMPLE_RATE,
+            'routes': instrumentation.route_stats(),
+            'cache': cache_stats()}, indent=2, sort_keys=True))
+
+    def post(self):
+        """Clear this instance's per route call counts"""
+        instrumentation.reset()
+
+
+app = instrumentation.wrap(webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
-    ('/tasks/send_your_turn', SendYourTurnEmail),
-], debug=True)
+    ('/tasks/send_reminders', SendReminderBatch),
+    (notifications.TURN_NOTIFICATION_URL, SendYourTurnEmail),
+    (scoring.RECORD_SCORES_URL, RecordScores),
+    (scoring.AGGREGATE_SCORES_URL, AggregateScores),
+    ('/crons/archive_games', ArchiveGames),
+    (archive.ARCHIVE_GAMES_URL, ArchiveGamesBatch),
+    ('/crons/sweep_games', SweepGames),
+    (sweeper.SWEEP_GAMES_URL, SweepGamesBatch),
+    ('/admin/stats', Stats),
+], debug=True))
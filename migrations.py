@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+
+"""migrations.py - This file contains admin-only handlers that move existing
+Datastore rows to a new storage layout. Each migration works through its kind
+one cursor-sized batch at a time and queues itself to pick up the next batch,
+so it can be started once after a deploy and safely restarted if it fails."""
+
+import datetime
+import logging
+
+import webapp2
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from utils import invalidate
+from models import User, Game, Player, Dice, GameHistory, Score
+from models import ScoreHistogram, GameHistoryBucket
+import instrumentation
+import leaderboard
+
+BATCH_SIZE = 50
+
+
+class MigrationHandler(webapp2.RequestHandler):
+    """Base class for batched migrations. Subclasses implement migrate_batch
+    and query, and the handler takes care of paging and chaining."""
+    url = None
+
+    def query(self):
+        raise NotImplementedError
+
+    def migrate_batch(self, entities):
+        raise NotImplementedError
+
+    def get(self):
+        """Starts the migration from the beginning"""
+        taskqueue.add(url=self.url)
+        self.response.write('Migration queued.')
+
+    def post(self):
+        """Migrates one batch and queues the next"""
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = Cursor(urlsafe=self.request.get('cursor'))
+        entities, next_cursor, more = self.query().fetch_page(
+            BATCH_SIZE, start_cursor=cursor)
+        self.migrate_batch(entities)
+        if more and next_cursor:
+            taskqueue.add(url=self.url,
+                          params={'cursor': next_cursor.urlsafe()})
+        else:
+            logging.info('Migration %s finished.', self.url)
+
+
+class MigrateDice(MigrationHandler):
+    """Packs legacy Dice rows into Player.hand and removes them"""
+    url = '/admin/migrate/dice'
+
+    def query(self):
+        return Player.query()
+
+    def migrate_batch(self, players):
+        players = [player for player in players if not player.hand]
+        if not players:
+            return
+        dice_queries = [Dice.query(Dice.player == player.key).fetch_async()
+                        for player in players]
+        games = ndb.get_multi([player.game for player in players])
+        stale_dice = []
+        for player, game, dice_query in zip(players, games, dice_queries):
+            dice = dice_query.get_result()
+            hand = Dice.pack(dice)
+            if game:
+                hand.extend([0] * (game.die_faces - len(hand)))
+            player.hand = hand
+            stale_dice.extend(die.key for die in dice)
+        ndb.put_multi(players)
+        ndb.delete_multi(stale_dice)
+
+
+
+class MigrateEntityGroups(MigrationHandler):
+    """Re-creates root Player and GameHistory rows as children of their
+    Game and removes the originals. Legacy Dice rows are folded into the
+    new players' hands on the way."""
+    url = '/admin/migrate/entity_groups'
+
+    def query(self):
+        return Game.query()
+
+    def migrate_batch(self, games):
+        for game in games:
+            self.migrate_game(game)
+
+    def migrate_game(self, game):
+        old_players = [player for player in
+                       Player.query(Player.game == game.key)
+                       if player.key.parent() is None]
+        old_history = [turn for turn in
+                       GameHistory.query(GameHistory.game == game.key)
+                       if turn.key.parent() is None]
+        if not old_players and not old_history:
+            return
+        new_entities = []
+        stale_keys = []
+        player_keys = {}
+        for player in old_players:
+            new_player = Player(parent=game.key, id=player.order,
+                                game=game.key, user=player.user,
+                                order=player.order, hand=player.get_hand())
+            player_keys[player.key] = new_player.key
+            new_entities.append(new_player)
+            stale_keys.append(player.key)
+            stale_keys.extend(Dice.query(Dice.player == player.key)
+                                  .fetch(keys_only=True))
+        for turn in old_history:
+            new_entities.append(GameHistory(
+                parent=game.key,
+                game=game.key,
+                turn=turn.turn,
+                player=player_keys.get(turn.player, turn.player),
+                bid_face=turn.bid_face,
+                bid_total=turn.bid_total))
+            stale_keys.append(turn.key)
+        ndb.put_multi(new_entities)
+        ndb.delete_multi(stale_keys)
+
+
+
+class MigrateSeats(MigrationHandler):
+    """Stores the seat table on games created before it was recorded"""
+    url = '/admin/migrate/seats'
+
+    def query(self):
+        return Game.query()
+
+    def migrate_batch(self, games):
+        for game in games:
+            if (not game.seats and
+                    self.migrate_game(game.key, game.get_seats())):
+                invalidate(game.key)
+
+    @ndb.transactional
+    def migrate_game(self, game_key, seats):
+        # Re-read so a move made since the batch was fetched is kept
+        game = game_key.get()
+        if game.seats:
+            return False
+        game.seats = seats
+        game.version += 1
+        # Saving also fills in the computed turn_user
+        game.put()
+        return True
+
+
+
+class MigrateUserKeys(MigrationHandler):
+    """Re-keys Users and their Scores by normalized user name and points
+    Players, seats and winners at the new keys. Users whose names collide
+    once normalized are logged and left alone."""
+    url = '/admin/migrate/user_keys'
+
+    def query(self):
+        return User.query()
+
+    def migrate_batch(self, users):
+        for user in users:
+            if isinstance(user.key.id(), basestring):
+                continue
+            self.migrate_user(user)
+
+    def migrate_user(self, user):
+        old_key = user.key
+        new_key = User.key_for(user.user_name)
+        if new_key.get():
+            logging.warning('Cannot migrate user %s, the name %s is taken.',
+                            old_key.id(), new_key.id())
+            return
+        old_score = Score.query(Score.user == old_key).get()
+        new_user = User(key=new_key, user_name=user.user_name,
+                        password=user.password, email=user.email)
+        new_score = Score(key=Score.key_for(new_key), user=new_key,
+                          user_name=user.user_name)
+        if old_score:
+            new_score.populate(games=old_score.games, wins=old_score.wins,
+                               score=old_score.score)
+        ndb.put_multi([new_user, new_score])
+        players_by_game = {}
+        for player_key in Player.query(Player.user == old_key).iter(
+                keys_only=True):
+            game_key = player_key.parent()
+            if game_key is None:
+                # Players that predate entity groups point at their game
+                game_key = player_key.get().game
+            players_by_game.setdefault(game_key, []).append(player_key)
+        for game_key in Game.query(Game.winner == old_key).iter(
+                keys_only=True):
+            players_by_game.setdefault(game_key, [])
+        for game_key, player_keys in players_by_game.iteritems():
+            self.migrate_game(game_key, player_keys, old_key, new_key)
+        stale_keys = [old_key]
+        if old_score:
+            stale_keys.append(old_score.key)
+        ndb.delete_multi(stale_keys)
+        for game_key in players_by_game:
+            if game_key is not None:
+                invalidate(game_key)
+
+    @ndb.transactional(xg=True)
+    def migrate_game(self, game_key, player_keys, old_key, new_key):
+        # Re-read so a move made since the players were found is kept.
+        # Players that predate entity groups are their own groups, hence xg.
+        game = game_key.get() if game_key is not None else None
+        players = ndb.get_multi(player_keys)
+        updated = []
+        for player in players:
+            if player and player.user == old_key:
+                player.user = new_key
+                updated.append(player)
+        if game:
+            if game.winner == old_key:
+                game.winner = new_key
+            for seat in game.seats:
+                if seat.user == old_key:
+                    seat.user = new_key
+            game.version += 1
+            updated.append(game)
+        ndb.put_multi(updated)
+
+
+
+class MigrateScoreNames(MigrationHandler):
+    """Stores the user name on Scores created before it was denormalized"""
+    url = '/admin/migrate/score_names'
+
+    def query(self):
+        return Score.query()
+
+    def migrate_batch(self, scores):
+        scores = [score for score in scores if not score.user_name]
+        users = ndb.get_multi([score.user for score in scores])
+        for score, user in zip(scores, users):
+            if user:
+                self.migrate_score(score.key, user.user_name)
+
+    @ndb.transactional
+    def migrate_score(self, score_key, user_name):
+        # Re-read so events applied since the batch was fetched are kept
+        score = score_key.get()
+        if score and not score.user_name:
+            score.user_name = user_name
+            score.put()
+
+
+
+class RebuildScoreHistogram(MigrationHandler):
+    """Recounts the score histogram from every Score"""
+    url = '/admin/migrate/score_histogram'
+
+    def query(self):
+        return Score.query(projection=[Score.score])
+
+    def post(self):
+        if not self.request.get('cursor'):
+            ScoreHistogram(id=leaderboard.HISTOGRAM_ID, counts={}).put()
+        super(RebuildScoreHistogram, self).post()
+
+    def migrate_batch(self, scores):
+        leaderboard.scores_changed([(None, score.score) for score in scores])
+
+
+
+class MigrateActivePlayers(MigrationHandler):
+    """Flags the players of games still in progress as active"""
+    url = '/admin/migrate/active_players'
+
+    def query(self):
+        return Player.query()
+
+    def migrate_batch(self, players):
+        for player in players:
+            self.migrate_player(player.key, player.key.parent() or player.game)
+
+    @ndb.transactional(xg=True)
+    def migrate_player(self, player_key, game_key):
+        # Re-read both so a game ended since the batch was fetched is seen
+        player, game = ndb.get_multi([player_key, game_key])
+        if not player:
+            return
+        player.active = bool(game and not game.game_over and
+                             not game.cancelled)
+        player.put()
+
+
+
+class MigrateTurnUsers(MigrationHandler):
+    """Re-saves games in progress so their computed turn_user is indexed"""
+    url = '/admin/migrate/turn_users'
+
+    def query(self):
+        return Game.query(Game.game_over == False, Game.cancelled == False)
+
+    def migrate_batch(self, games):
+        for game in games:
+            if self.migrate_game(game.key):
+                invalidate(game.key)
+
+    @ndb.transactional
+    def migrate_game(self, game_key):
+        # Re-read so a move made since the batch was fetched is kept
+        game = game_key.get()
+        if game.game_over or game.cancelled:
+            return False
+        game.version += 1
+        game.put()
+        return True
+
+
+
+class MigrateHistoryBuckets(MigrationHandler):
+    """Packs per-turn GameHistory rows into GameHistoryBuckets and removes
+    them (run after entity_groups)"""
+    url = '/admin/migrate/history_buckets'
+
+    def query(self):
+        return Game.query()
+
+    def migrate_batch(self, games):
+        for game in games:
+            self.migrate_game(game.key)
+
+    @ndb.transactional
+    def migrate_game(self, game_key):
+        # Players, history and buckets all sit in the game's entity group,
+        # so a bid placed while the game is migrated is never lost
+        game = game_key.get()
+        history = (GameHistory.query(ancestor=game_key)
+                              .order(GameHistory.turn).fetch())
+        if not game or not history:
+            return
+        orders = dict((player.key, player.order)
+                      for player in Player.query(ancestor=game_key))
+        unknown = [turn.turn for turn in history
+                   if turn.player not in orders]
+        if unknown:
+            # Buckets cannot leave a gap, so the game keeps its rows
+            logging.warning('Cannot migrate the history of game %s, the '
+                            'players of turns %s are not in the game.',
+                            game_key.urlsafe(), unknown)
+            return
+        turns = dict((turn.turn, (orders[turn.player], turn.bid_face,
+                                  turn.bid_total))
+                     for turn in history)
+        # Bids made since the deploy are already in buckets
+        for bucket in ndb.get_multi(GameHistoryBucket.keys_for(game)):
+            if bucket is None:
+                continue
+            for index in range(0, len(bucket.turns), 3):
+                turns[bucket.first_turn + index // 3] = tuple(
+                    bucket.turns[index:index + 3])
+        buckets = {}
+        for turn in sorted(turns):
+            bucket_key = GameHistoryBucket.key_for(game_key, turn)
+            if bucket_key not in buckets:
+                buckets[bucket_key] = GameHistoryBucket(key=bucket_key,
+                                                        first_turn=turn)
+            buckets[bucket_key].append(*turns[turn])
+        ndb.put_multi(buckets.values())
+        ndb.delete_multi([turn.key for turn in history])
+
+
+class MigrateFinishedGames(MigrationHandler):
+    """Re-saves ended games so their computed finished flag is indexed and
+    the archive job can find them"""
+    url = '/admin/migrate/finished_games'
+
+    def query(self):
+        return Game.query()
+
+    def migrate_batch(self, games):
+        for game in games:
+            if ((game.game_over or game.cancelled) and not game.archived
+                    and self.migrate_game(game.key)):
+                invalidate(game.key)
+
+    @ndb.transactional
+    def migrate_game(self, game_key):
+        # Re-read so an archive written since the batch was fetched is kept
+        game = game_key.get()
+        if game.archived or not (game.game_over or game.cancelled):
+            return False
+        game.version += 1
+        game.put()
+        return True
+
+
+class MigrateLastMoves(MigrationHandler):
+    """Starts the idle clock of games in progress that predate last_move,
+    so the sweeper can time them out"""
+    url = '/admin/migrate/last_moves'
+
+    def query(self):
+        return Game.query(Game.game_over == False, Game.cancelled == False)
+
+    def migrate_batch(self, games):
+        now = datetime.datetime.utcnow()
+        for game in games:
+            if not game.last_move and self.migrate_game(game.key, now):
+                invalidate(game.key)
+
+    @ndb.transactional
+    def migrate_game(self, game_key, now):
+        # Re-read so a move made since the batch was fetched is kept
+        game = game_key.get()
+        if game.last_move or game.game_over or game.cancelled:
+            return False
+        game.last_move = now
+        game.version += 1
+        game.put()
+        return True
+
+
+# In the order they must run
+MIGRATIONS = [
+    MigrateDice,
+    MigrateEntityGroups,
+    MigrateSeats,
+    MigrateUserKeys,
+    MigrateScoreNames,
+    RebuildScoreHistogram,
+    MigrateActivePlayers,
+    MigrateTurnUsers,
+    MigrateHistoryBuckets,
+    MigrateFinishedGames,
+    MigrateLastMoves,
+]
+
+app = instrumentation.wrap(webapp2.WSGIApplication(
+    [(migration.url, migration) for migration in MIGRATIONS], debug=True))
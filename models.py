@@ -2,44 +2,103 @@
 entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
 
-import random
+import datetime
 from datetime import date
 from protorpc import messages
 from google.appengine.ext import ndb
 
+import rules
+
 # Will maybe someday split this up into different files.
 
+# How many turns each GameHistoryBucket holds
+HISTORY_BUCKET_TURNS = 100
+
 
 class User(ndb.Model):
-    """User profile"""
+    """User profile. Keyed by the normalized user name."""
     user_name = ndb.StringProperty(required=True)
-    password = ndb.StringProperty()
+    password = ndb.StringProperty(indexed=False)
     email = ndb.StringProperty()
 
+    @staticmethod
+    def normalize(user_name):
+        """Returns the form of a user name used as its key"""
+        return user_name.strip().lower()
+
+    @classmethod
+    def key_for(cls, user_name):
+        """Returns the key of the user with user_name"""
+        return ndb.Key(cls, cls.normalize(user_name))
+
+
+class SessionSecret(ndb.Model):
+    """Key used to sign session tokens"""
+    secret = ndb.BlobProperty(required=True)
+
+
+class Seat(ndb.Model):
+    """A place at a game's table. Stored on the Game so whose turn it is can
+    be worked out without reading Player or User entities."""
+    player = ndb.KeyProperty(kind='Player')
+    user = ndb.KeyProperty(kind='User')
+    user_name = ndb.StringProperty()
+    # Whether the user had an email when seated, None for older seats
+    has_email = ndb.BooleanProperty()
+
 
 class Game(ndb.Model):
     """Game object"""
-    players = ndb.IntegerProperty(required=True)
-    die_faces = ndb.IntegerProperty(required=True)
-    dice_total = ndb.IntegerProperty(required=True)
-    wild = ndb.IntegerProperty(required=True)
+    # Games are cached by utils.get_cached with explicit write-through
+    _use_memcache = False
+
+    players = ndb.IntegerProperty(required=True, indexed=False)
+    die_faces = ndb.IntegerProperty(required=True, indexed=False)
+    dice_total = ndb.IntegerProperty(required=True, indexed=False)
+    wild = ndb.IntegerProperty(required=True, indexed=False)
     game_over = ndb.BooleanProperty(required=True, default=False)
     cancelled = ndb.BooleanProperty(required=True, default=False)
-    turn = ndb.IntegerProperty(required=True)
-    bid_player = ndb.IntegerProperty(required=True)
-    bid_face = ndb.IntegerProperty(required=True)
-    bid_total = ndb.IntegerProperty(required=True)
+    turn = ndb.IntegerProperty(required=True, indexed=False)
+    bid_player = ndb.IntegerProperty(required=True, indexed=False)
+    bid_face = ndb.IntegerProperty(required=True, indexed=False)
+    bid_total = ndb.IntegerProperty(required=True, indexed=False)
+    # Indexed for the user_keys migration, which finds games won by users
+    # still keyed the old way
     winner = ndb.KeyProperty(kind='User')
+    # Face counts across every hand at the table, index 0 holds face 1
+    histogram = ndb.IntegerProperty(repeated=True, indexed=False)
+    # Seat table in play order, seats[0] is player 1
+    seats = ndb.LocalStructuredProperty(Seat, repeated=True)
+    # Bumped on every change to the game, stamps cached copies
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    # When the game started or last had a bid raised, finds abandoned games
+    last_move = ndb.DateTimeProperty()
+    # Who the game is waiting on, None once it is over. Lets reminders find
+    # the games awaiting a user with one indexed query.
+    turn_user = ndb.ComputedProperty(lambda self: self._turn_user())
+    # Lets the archive job find ended games with one indexed query
+    finished = ndb.ComputedProperty(
+        lambda self: self.game_over or self.cancelled)
+    # Set once the game's hands and history have been packed into archive
+    # and their entities deleted
+    archived = ndb.BooleanProperty(default=False)
+    # {'hands': [hand per seat], 'buckets': [[first_turn, turns], ...]}
+    archive = ndb.JsonProperty(compressed=True)
 
     @classmethod
     def new_game(cls, users, dice_per_player, dice_sides, wild):
-        """Creates and returns a new game"""
-        if dice_per_player < 1:
-            raise ValueError('At least 1 die is needed to play.')
-        if dice_sides < 1:
-            raise ValueError('Can only play in positive space.')
+        """Creates and returns a new game. Expects the User entities for each
+        seat in play order so no further user lookups are needed. Players are
+        keyed by seat under the game, so once the game key is allocated the
+        Game and its Players (each carrying its own roll) are written in a
+        single batched put."""
+        rules.check_setup(dice_per_player, dice_sides)
+        # Reserve the game key so its players can be built under it before
+        # anything is written
+        game_ids = Game.allocate_ids(1)
         # Set up game
-        game = Game(players=len(users),
+        game = Game(id=game_ids[0],
+                    players=len(users),
                     die_faces=dice_sides,
                     dice_total=dice_per_player,
                     wild=wild,
@@ -47,31 +106,103 @@ class Game(ndb.Model):
                     turn=0,
                     bid_player=0,
                     bid_face=1,
-                    bid_total=0)
-        game.put()
+                    bid_total=0,
+                    last_move=datetime.datetime.utcnow())
+        entities = [game]
+        histogram = [0]*dice_sides
         # Set up players
-        for player_number in range(0, len(users)):
-            user = User.query(User.user_name == users[player_number]).get()
-            player = Player(game=game.key, order=player_number+1,
+        for player_number, user in enumerate(users):
+            player = Player(parent=game.key, id=player_number+1,
+                            game=game.key, order=player_number+1,
                             user=user.key)
-            player.put()
-            dice_array = [0]*dice_sides
-            for die in range(0, dice_per_player):
-                roll = random.randrange(0, dice_sides, 1)
-                dice_array[roll] += 1
-            for face, total in enumerate(dice_array):
-                if total != 0:
-                    (Dice(player=player.key, face=face+1,
-                          total=total).put())
+            entities.append(player)
+            game.seats.append(Seat(player=player.key, user=user.key,
+                                   user_name=user.user_name,
+                                   has_email=bool(user.email)))
+            player.hand = rules.roll(dice_per_player, dice_sides)
+            for face, total in enumerate(player.hand):
+                histogram[face] += total
+        game.histogram = histogram
+        ndb.put_multi(entities)
         return game
 
+    def get_seats(self):
+        """Returns the seat table. Games created before seats were stored
+        build it from their Players and Users instead."""
+        if self.seats:
+            return self.seats
+        players = Player.query(ancestor=self.key).order(Player.order).fetch()
+        users = ndb.get_multi([player.user for player in players])
+        return [Seat(player=player.key, user=user.key,
+                     user_name=user.user_name, has_email=bool(user.email))
+                for player, user in zip(players, users)]
+
+    def seat(self, order):
+        """Returns the Seat for the player at order, counting from 1"""
+        seats = self.get_seats()
+        if not 0 < order <= len(seats):
+            raise IndexError('No seat {} in a game of {}.'.format(
+                order, len(seats)))
+        return seats[order - 1]
+
+    def bidding_seat(self):
+        """Returns the Seat of the player who made the current bid"""
+        return self.seat(self.bid_player)
+
+    def turn_seat(self):
+        """Returns the Seat of the player whose turn it is"""
+        return self.seat(rules.next_player(self.bid_player, self.players))
+
+    def _turn_user(self):
+        if self.game_over or self.cancelled or not self.seats:
+            return None
+        return self.seats[
+            rules.next_player(self.bid_player, self.players) - 1].user
+
+    def user_name_for(self, user_key):
+        """Returns the name of a seated user"""
+        for seat in self.get_seats():
+            if seat.user == user_key:
+                return seat.user_name
+        return user_key.get().user_name
+
+    def archived_players(self):
+        """Returns the Players of an archived game, rebuilt unsaved from the
+        archive in play order"""
+        return [Player(key=Player.key_for(self.key, order), game=self.key,
+                       user=seat.user, order=order, hand=hand, active=False)
+                for order, (seat, hand) in enumerate(
+                    zip(self.get_seats(), self.archive['hands']), 1)]
+
+    def archived_buckets(self):
+        """Returns the GameHistoryBuckets of an archived game, rebuilt
+        unsaved from the archive in turn order"""
+        return [GameHistoryBucket(first_turn=first_turn, turns=turns)
+                for first_turn, turns in self.archive['buckets']]
+
+    def get_histogram(self):
+        """Returns the table's face counts. Games created before the
+        histogram was recorded add up their players' hands instead."""
+        if self.histogram:
+            return self.histogram
+        histogram = [0]*self.die_faces
+        for player in Player.query(ancestor=self.key):
+            for face, total in enumerate(player.get_hand()[:self.die_faces]):
+                histogram[face] += total
+        return histogram
+
+    def count_face(self, face):
+        """Returns how many dice at the table count towards a bid on face,
+        including wilds. A wild of 0 means no face is wild."""
+        return rules.count_face(self.get_histogram(), face, self.wild)
+
     def to_form(self, message):
         """Returns a GameForm representation of the Game"""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
         form.players = self.players
         if self.winner:
-            form.winner = self.winner.get().user_name
+            form.winner = self.user_name_for(self.winner)
         form.die_faces = self.die_faces
         form.dice_total = self.dice_total
         form.bid_player = self.bid_player
@@ -80,61 +211,203 @@ class Game(ndb.Model):
         form.game_over = self.game_over
         form.cancelled = self.cancelled
         form.turn = self.turn
+        form.version = self.version
         form.message = message
         return form
 
 
 class Player(ndb.Model):
-    """Player object to map users to game"""
+    """Player object to map users to game. Players are children of their
+    Game, keyed by their seat order."""
+    # Indexed for the entity_groups migration, which finds the root Players
+    # of games created before they were children
     game = ndb.KeyProperty(required=True, kind='Game')
     user = ndb.KeyProperty(required=True, kind='User')
     order = ndb.IntegerProperty(required=True)
+    # Packed roll: hand[i] is how many dice show face i + 1
+    hand = ndb.IntegerProperty(repeated=True, indexed=False)
+    # True until the game ends or is cancelled, indexes a user's active games
+    active = ndb.BooleanProperty(default=True)
+
+    @classmethod
+    def key_for(cls, game_key, order):
+        """Returns the key of the player sitting at order in a game"""
+        return ndb.Key(cls, order, parent=game_key)
+
+    @classmethod
+    def keys_for(cls, game_key, players):
+        """Returns the keys of every player in a game, in play order"""
+        return [cls.key_for(game_key, order)
+                for order in range(1, players + 1)]
+
+    def get_hand(self):
+        """Returns the packed face counts for this player. Players created
+        before hands were packed still have their roll in Dice entities, so
+        those are read instead until the migration has run."""
+        if self.hand:
+            return self.hand
+        return Dice.pack(Dice.query(Dice.player == self.key))
 
 
 class Dice(ndb.Model):
+    """Legacy per-face roll storage. Rolls now live in Player.hand, this
+    model is kept to read and migrate games created before that."""
     player = ndb.KeyProperty(required=True, kind='Player')
-    face = ndb.IntegerProperty(required=True)
-    total = ndb.IntegerProperty(required=True)
+    face = ndb.IntegerProperty(required=True, indexed=False)
+    total = ndb.IntegerProperty(required=True, indexed=False)
+
+    @staticmethod
+    def pack(dice):
+        """Folds Dice entities into a packed face count list"""
+        hand = []
+        for die in dice:
+            if die.face > len(hand):
+                hand.extend([0] * (die.face - len(hand)))
+            hand[die.face - 1] += die.total
+        return hand
 
     @classmethod
-    def to_form(self, dice_query):
+    def to_form(self, players):
+        """Returns DiceForms for the hands of the given players"""
         dice = []
-        for item in dice_query:
-            form = DiceForm()
-            player = item.player.get()
-            form.player = player.order
-            form.face = item.face
-            form.total = item.total
-            dice.append(form)
+        for player in sorted(players, key=lambda player: player.key):
+            for face, total in enumerate(player.get_hand()):
+                if total != 0:
+                    form = DiceForm()
+                    form.player = player.order
+                    form.face = face + 1
+                    form.total = total
+                    dice.append(form)
         forms = DiceForms()
         forms.dice = dice
         return forms
 
 
 class Score(ndb.Model):
+    """A user's all time score. Shares its key name with the User."""
+    # Indexed for the user_keys migration, which finds the Scores of users
+    # still keyed the old way
     user = ndb.KeyProperty(required=True, kind='User')
-    games = ndb.IntegerProperty(required=True, default=0)
-    wins = ndb.IntegerProperty(required=True, default=0)
+    user_name = ndb.StringProperty(indexed=False)
+    games = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    wins = ndb.IntegerProperty(required=True, default=0, indexed=False)
     # Total number of turns took to win a game
     score = ndb.IntegerProperty(required=True, default=0)
 
+    @classmethod
+    def key_for(cls, user_key):
+        """Returns the key of a user's Score"""
+        return ndb.Key(cls, user_key.id())
+
+    def get_user_name(self):
+        """Returns the user's name. Scores created before the name was
+        stored on them look it up instead."""
+        if self.user_name:
+            return self.user_name
+        return self.user.get().user_name
+
     def to_form(self, rank):
         """Returns a GameForm representation of the Game"""
         form = ScoreForm()
         form.rank = rank
-        form.user_name = self.user.get().user_name
+        form.user_name = self.get_user_name()
         form.games = self.games
         form.wins = self.wins
         form.score = self.score
         return form
 
 
+class ScoreEvent(ndb.Model):
+    """A player's result from one finished game, waiting to be added to
+    their Score. Keyed by game and user so it is only ever counted once."""
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+    user_name = ndb.StringProperty(indexed=False)
+    games = ndb.IntegerProperty(default=0, indexed=False)
+    wins = ndb.IntegerProperty(default=0, indexed=False)
+    score = ndb.IntegerProperty(default=0, indexed=False)
+    applied = ndb.BooleanProperty(default=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    # The Score change this event made, waiting to be counted in the
+    # ScoreHistogram. A from score of None means the Score was created.
+    histogram_pending = ndb.BooleanProperty(default=False)
+    histogram_from = ndb.IntegerProperty(indexed=False)
+    histogram_to = ndb.IntegerProperty(indexed=False)
+
+    @staticmethod
+    def id_for(game_key, user_key):
+        """Returns the key name of a user's event for a game"""
+        return '{}:{}'.format(game_key.id(), user_key.id())
+
+
+class ScoreHistogram(ndb.Model):
+    """How many users have each score, used to rank a single user without
+    scanning every Score. A single entity keyed 'scores'."""
+    # Maps a score, as a string, to the number of users with it
+    counts = ndb.JsonProperty()
+
+    def users_above(self, score):
+        """Returns how many users have a higher score"""
+        return sum(count for bucket, count in (self.counts or {}).iteritems()
+                   if int(bucket) > score)
+
+
+class GameHistoryBucket(ndb.Model):
+    """A run of up to HISTORY_BUCKET_TURNS raised bids in a game, packed as
+    (seat order, bid face, bid total) per turn. Children of their Game, keyed
+    by bucket number starting from 1."""
+    # Turn number of the first bid in the bucket
+    first_turn = ndb.IntegerProperty(required=True, indexed=False)
+    turns = ndb.IntegerProperty(repeated=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, game_key, turn):
+        """Returns the key of the bucket holding a turn"""
+        return ndb.Key(cls, (turn - 1) // HISTORY_BUCKET_TURNS + 1,
+                       parent=game_key)
+
+    @classmethod
+    def keys_for(cls, game):
+        """Returns the keys of every bucket in a game, in turn order"""
+        if game.turn < 1:
+            return []
+        return [ndb.Key(cls, number, parent=game.key) for number in
+                range(1, (game.turn - 1) // HISTORY_BUCKET_TURNS + 2)]
+
+    def append(self, seat, bid_face, bid_total):
+        self.turns.extend([seat, bid_face, bid_total])
+
+    @classmethod
+    def to_form(cls, game, buckets):
+        """Returns GameHistoryForms for a game's buckets, naming bidders
+        from the game's seat table"""
+        seats = game.get_seats()
+        game_history = []
+        for bucket in buckets:
+            first_turn = bucket.first_turn
+            for index in range(0, len(bucket.turns), 3):
+                seat, bid_face, bid_total = bucket.turns[index:index + 3]
+                form = GameHistoryForm()
+                form.turn = first_turn + index // 3
+                form.user_name = seats[seat - 1].user_name
+                form.bid_face = bid_face
+                form.bid_total = bid_total
+                game_history.append(form)
+        forms = GameHistoryForms()
+        forms.game_history = game_history
+        return forms
+
+
 class GameHistory(ndb.Model):
+    """Legacy storage for a raised bid, one entity per turn. Bids are now
+    packed into GameHistoryBucket, this model is kept to read and migrate
+    games played before that."""
+    # Indexed for the entity_groups migration, which finds the root rows of
+    # games created before they were children
     game = ndb.KeyProperty(required=True, kind='Game')
     turn = ndb.IntegerProperty(required=True)
-    player = ndb.KeyProperty(required=True, kind='Player')
-    bid_face = ndb.IntegerProperty(required=True)
-    bid_total = ndb.IntegerProperty(required=True)
+    player = ndb.KeyProperty(required=True, kind='Player', indexed=False)
+    bid_face = ndb.IntegerProperty(required=True, indexed=False)
+    bid_total = ndb.IntegerProperty(required=True, indexed=False)
 
     @classmethod
     def to_form(self, history_query):
@@ -170,11 +443,14 @@ class GameForm(messages.Message):
     bid_player = messages.IntegerField(10, required=True)
     bid_face = messages.IntegerField(11, required=True)
     bid_total = messages.IntegerField(12, required=True)
+    version = messages.IntegerField(13)
+    modified = messages.BooleanField(14, default=True)
 
 
 class GameForms(messages.Message):
     """Used to raise the bid in an existing game"""
     games = messages.MessageField(GameForm, 1, repeated=True)
+    cursor = messages.StringField(2)
 
 
 class NewGameForm(messages.Message):
@@ -190,6 +466,7 @@ class RaiseBidForm(messages.Message):
     bid_face = messages.IntegerField(1, required=True)
     bid_total = messages.IntegerField(2, required=True)
     password = messages.StringField(3)
+    token = messages.StringField(4)
 
 
 class DiceForm(messages.Message):
@@ -204,6 +481,46 @@ class DiceForms(messages.Message):
     dice = messages.MessageField(DiceForm, 1, repeated=True)
 
 
+class OddsForm(messages.Message):
+    """The chance that the current bid holds, as seen by one player"""
+    bid_face = messages.IntegerField(1, required=True)
+    bid_total = messages.IntegerField(2, required=True)
+    known = messages.IntegerField(3, required=True)
+    unknown = messages.IntegerField(4, required=True)
+    probability = messages.FloatField(5, required=True)
+
+
+class DashboardForm(messages.Message):
+    """A game's state along with the requesting user's dice in it"""
+    game = messages.MessageField(GameForm, 1, required=True)
+    dice = messages.MessageField(DiceForm, 2, repeated=True)
+
+
+class DashboardForms(messages.Message):
+    """Multiple DashboardForm container"""
+    games = messages.MessageField(DashboardForm, 1, repeated=True)
+
+
+class BidForm(messages.Message):
+    """A bid in one of several games"""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    bid_face = messages.IntegerField(2, required=True)
+    bid_total = messages.IntegerField(3, required=True)
+
+
+class RaiseBidsForm(messages.Message):
+    """Used to raise bids in several games at once"""
+    bids = messages.MessageField(BidForm, 1, repeated=True)
+    password = messages.StringField(2)
+    token = messages.StringField(3)
+
+
+class SessionForm(messages.Message):
+    """Session token issued on login"""
+    token = messages.StringField(1, required=True)
+    expires = messages.IntegerField(2, required=True)
+
+
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     message = messages.StringField(1, required=True)
@@ -232,3 +549,4 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """A form to send the history for a game."""
     scores = messages.MessageField(ScoreForm, 1, repeated=True)
+    cursor = messages.StringField(2)
@@ -0,0 +1,73 @@
+"""notifications.py - Coalesced "your turn" emails. A move only queues a
+task naming the user whose turn it now is. Moves made for the same user
+within NOTIFY_INTERVAL share one named task, which emails them a single
+summary of every game waiting on them when it runs."""
+
+import hashlib
+import time
+
+from google.appengine.api import mail, app_identity, taskqueue
+from google.appengine.ext import ndb
+
+from models import Game
+from utils import get_multi_cached
+
+TURN_NOTIFICATION_URL = '/tasks/send_your_turn'
+# Turn notifications for a user are gathered for this long, in seconds
+NOTIFY_INTERVAL = 60
+
+
+@ndb.tasklet
+def notify_turn_async(seat):
+    """Queues a turn notification for the user in a seat, unless they have
+    no email to send it to. A notification already pending for the user
+    covers this move too."""
+    if seat.has_email is False:
+        return
+    user_key = seat.user
+    window = int(time.time() // NOTIFY_INTERVAL)
+    # Task names only allow a few characters, user names may have others
+    user_hash = hashlib.md5(user_key.urlsafe()).hexdigest()
+    task = taskqueue.Task(url=TURN_NOTIFICATION_URL,
+                          name='turn-{}-{}'.format(user_hash, window),
+                          params={'user_key': user_key.urlsafe()},
+                          countdown=NOTIFY_INTERVAL)
+    try:
+        yield taskqueue.Queue().add_async(task)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def send_turn_email(user_key):
+    """Emails a user about every game currently waiting on their move"""
+    user = user_key.get()
+    if not user or not user.email:
+        return
+    game_keys = Game.query(Game.turn_user == user_key).fetch(keys_only=True)
+    games = [game for game in get_multi_cached(game_keys)
+             if game is not None and game.turn_user == user_key]
+    if not games:
+        return
+    app_id = app_identity.get_application_id()
+    subject = 'It''s your turn on Liar\'s Dice.'
+    body = ('Hello {}, your opponents are waiting for your action.'
+            .format(user.user_name))
+    for game in games:
+        if game.turn == 0:
+            body += ("\n\nGame {}: a new game is waiting for your opening "
+                     "bid.".format(game.key.urlsafe()))
+            continue
+        body += (
+            "\n\nGame {}: {} raised the bid to face: {}, total: {}. "
+            "Is it a lie?"
+            .format(
+                game.key.urlsafe(),
+                game.bidding_seat().user_name,
+                game.bid_face,
+                game.bid_total))
+    # This will send test emails, the arguments to send_mail are:
+    # from, to, subject, body
+    mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                   user.email,
+                   subject,
+                   body)
@@ -0,0 +1,275 @@
+"""rules.py - The rules of Liar's Dice, kept apart from the Datastore.
+
+Rolling, bid validation, turn order and resolving a call of liar live here as
+plain functions over packed face counts, the same layout Player.hand and
+Game.histogram store: counts[i] is how many dice show face i + 1. The API and
+models call these, so anything checked here behaves exactly as the game does.
+
+GameState plays a whole game in memory, and the batch functions roll and
+resolve many tables at once. They use NumPy when it is installed and fall back
+to plain Python otherwise, which gives the same answers far more slowly."""
+
+import math
+import random
+import threading
+from array import array
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# How many odds tables to keep, each is two lists of unknown dice + 1 floats
+ODDS_CACHE_SIZE = 256
+
+_odds_tables = OrderedDict()
+_odds_lock = threading.Lock()
+
+
+class RuleError(ValueError):
+    """A move that the rules do not allow"""
+    pass
+
+
+def check_setup(dice_per_player, dice_sides):
+    """Raises a RuleError if a game cannot be played with these settings"""
+    if dice_per_player < 1:
+        raise RuleError('At least 1 die is needed to play.')
+    if dice_sides < 1:
+        raise RuleError('Can only play in positive space.')
+
+
+def roll(dice, dice_sides, rand=random):
+    """Rolls dice and returns their packed face counts"""
+    counts = [0] * dice_sides
+    for die in range(dice):
+        counts[rand.randrange(dice_sides)] += 1
+    return counts
+
+
+def count_face(histogram, face, wild):
+    """Returns how many dice in histogram count towards a bid on face,
+    including wilds. A wild of 0 means no face is wild."""
+    total = histogram[face - 1] if 0 < face <= len(histogram) else 0
+    if wild != face and 0 < wild <= len(histogram):
+        total += histogram[wild - 1]
+    return total
+
+
+def check_bid(bid_face, bid_total, current_face, current_total, die_faces,
+              dice_in_play):
+    """Raises a RuleError unless bid_face and bid_total raise the current
+    bid. A bid must raise the face, or keep it and raise the total."""
+    if current_face == die_faces and current_total == dice_in_play:
+        raise RuleError('Already at max possible bid. Bid cannot be rasied. '
+                        'Call liar to end game.')
+    if bid_face < 1 or bid_face > die_faces:
+        raise RuleError('Invalid face number. Must be between 1 and '
+                        + str(die_faces) + '.')
+    if bid_face < current_face:
+        raise RuleError('Invalid dice face. Must be greater than or equal to '
+                        'the current dice face bid:%d.' % current_face)
+    if bid_face == current_face and bid_total <= current_total:
+        raise RuleError('Invalid bid. If not raising dice face, must raise '
+                        'dice total')
+
+
+def next_player(bid_player, players):
+    """Returns the order of the player who bids after bid_player. Order 0
+    means no bid has been made, so player 1 starts."""
+    return bid_player % players + 1
+
+
+def bid_holds(histogram, bid_face, bid_total, wild):
+    """Returns True if the table really has bid_total dice of bid_face, in
+    which case the bidder wins a call of liar"""
+    return count_face(histogram, bid_face, wild) >= bid_total
+
+
+def _at_least(dice, chance):
+    """Returns at_least[k], the chance that k or more of dice each counting
+    with the given chance do count, for k from 0 to dice"""
+    if chance >= 1:
+        return [1.0] * (dice + 1)
+    if chance <= 0:
+        return [1.0] + [0.0] * dice
+    # Binomial probabilities of exactly k, worked out in log space so large
+    # tables do not underflow to all zeros
+    log_chance = math.log(chance)
+    log_miss = math.log(1 - chance)
+    log_dice = math.lgamma(dice + 1)
+    exactly = [math.exp(log_dice - math.lgamma(k + 1) -
+                        math.lgamma(dice - k + 1) +
+                        k * log_chance + (dice - k) * log_miss)
+               for k in range(dice + 1)]
+    at_least = [0.0] * (dice + 1)
+    running = 0.0
+    for k in range(dice, -1, -1):
+        running += exactly[k]
+        at_least[k] = min(running, 1.0)
+    # Some dice or none always count
+    at_least[0] = 1.0
+    return at_least
+
+
+def odds_table(unknown, die_faces, wild):
+    """Returns the cumulative odds tables for unknown dice, as a pair of
+    lists for bids on a face helped by wilds and bids on a face that is not.
+    Tables are built once and kept in a least recently used cache."""
+    key = (unknown, die_faces, wild)
+    with _odds_lock:
+        table = _odds_tables.pop(key, None)
+        if table is not None:
+            _odds_tables[key] = table
+            return table
+    plain = _at_least(unknown, 1.0 / die_faces)
+    if 0 < wild <= die_faces:
+        table = (_at_least(unknown, 2.0 / die_faces), plain)
+    else:
+        table = (plain, plain)
+    with _odds_lock:
+        _odds_tables[key] = table
+        while len(_odds_tables) > ODDS_CACHE_SIZE:
+            _odds_tables.popitem(last=False)
+    return table
+
+
+def bid_odds_for(hand, unknown, bid_face, bid_total, wild):
+    """Returns the chance that a bid holds for a player who can see hand
+    and not the other unknown dice at the table"""
+    needed = bid_total - count_face(hand, bid_face, wild)
+    if needed <= 0:
+        return 1.0
+    if needed > unknown:
+        return 0.0
+    wilds, no_wilds = odds_table(unknown, len(hand), wild)
+    if wild != bid_face and 0 < wild <= len(hand):
+        return wilds[needed]
+    return no_wilds[needed]
+
+
+class GameState(object):
+    """A game held entirely in memory. Hands are packed into one flat array,
+    hands[(order - 1) * die_faces + face - 1], next to the table's
+    histogram."""
+    __slots__ = ('players', 'die_faces', 'dice_total', 'wild', 'hands',
+                 'histogram', 'turn', 'bid_player', 'bid_face', 'bid_total',
+                 'winner')
+
+    def __init__(self, players, dice_per_player, dice_sides, wild,
+                 rand=random):
+        check_setup(dice_per_player, dice_sides)
+        self.players = players
+        self.die_faces = dice_sides
+        self.dice_total = dice_per_player
+        self.wild = wild
+        self.hands = array('i')
+        self.histogram = array('i', [0] * dice_sides)
+        for order in range(players):
+            hand = roll(dice_per_player, dice_sides, rand)
+            self.hands.extend(hand)
+            for face, total in enumerate(hand):
+                self.histogram[face] += total
+        self.turn = 0
+        self.bid_player = 0
+        self.bid_face = 1
+        self.bid_total = 0
+        self.winner = None
+
+    def hand(self, order):
+        """Returns the packed face counts of the player at order"""
+        start = (order - 1) * self.die_faces
+        return self.hands[start:start + self.die_faces].tolist()
+
+    def turn_player(self):
+        """Returns the order of the player whose turn it is"""
+        return next_player(self.bid_player, self.players)
+
+    def bid(self, bid_face, bid_total):
+        """Makes the next bid, raising a RuleError if it is not allowed"""
+        if self.winner is not None:
+            raise RuleError('Game already over!')
+        check_bid(bid_face, bid_total, self.bid_face, self.bid_total,
+                  self.die_faces, self.dice_total * self.players)
+        self.bid_face = bid_face
+        self.bid_total = bid_total
+        self.turn += 1
+        self.bid_player = next_player(self.bid_player, self.players)
+
+    def call_liar(self):
+        """Ends the game with the player whose turn it is calling the last
+        bid a lie. Returns the winner's order."""
+        if self.winner is not None:
+            raise RuleError('Game already over!')
+        if self.turn < 1:
+            raise RuleError('At least one turn must pass before calling liar.')
+        if bid_holds(self.histogram, self.bid_face, self.bid_total,
+                     self.wild):
+            self.winner = self.bid_player
+        else:
+            self.winner = self.turn_player()
+        return self.winner
+
+
+def roll_tables(games, players, dice_per_player, dice_sides, seed=None):
+    """Rolls the table of every player in many games at once. Returns each
+    game's histogram, a (games, dice_sides) array with NumPy or a list of
+    lists without it."""
+    check_setup(dice_per_player, dice_sides)
+    dice = players * dice_per_player
+    if numpy is None:
+        rand = random.Random(seed)
+        return [roll(dice, dice_sides, rand) for game in range(games)]
+    rolls = numpy.random.RandomState(seed).randint(
+        0, dice_sides, size=(games, dice))
+    # Offset each game's rolls into its own run of bins and count them all
+    # in one pass
+    rolls += (numpy.arange(games) * dice_sides)[:, None]
+    return numpy.bincount(rolls.ravel(), minlength=games * dice_sides) \
+        .reshape(games, dice_sides)
+
+
+def count_face_batch(histograms, face, wild):
+    """count_face over every histogram from roll_tables"""
+    if numpy is None:
+        return [count_face(histogram, face, wild)
+                for histogram in histograms]
+    totals = histograms[:, face - 1].copy()
+    if wild != face and 0 < wild <= histograms.shape[1]:
+        totals += histograms[:, wild - 1]
+    return totals
+
+
+def bid_holds_batch(histograms, bid_face, bid_total, wild):
+    """bid_holds over every histogram from roll_tables"""
+    totals = count_face_batch(histograms, bid_face, wild)
+    if numpy is None:
+        return [total >= bid_total for total in totals]
+    return totals >= bid_total
+
+
+def bid_odds(games, players, dice_per_player, dice_sides, wild, seed=None):
+    """Estimates how often each bid holds by rolling games tables. Returns
+    odds[face - 1][total] as the fraction of tables with at least total dice
+    counting towards face."""
+    histograms = roll_tables(games, players, dice_per_player, dice_sides,
+                             seed)
+    dice = players * dice_per_player
+    odds = []
+    for face in range(1, dice_sides + 1):
+        totals = count_face_batch(histograms, face, wild)
+        if numpy is None:
+            tally = [0] * (dice + 1)
+            for total in totals:
+                tally[total] += 1
+        else:
+            tally = numpy.bincount(totals, minlength=dice + 1).tolist()
+        # Tables with at least total dice, counted down from the most
+        at_least = []
+        running = 0
+        for count in reversed(tally):
+            running += count
+            at_least.append(float(running) / games)
+        odds.append(at_least[::-1])
+    return odds
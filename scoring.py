@@ -0,0 +1,135 @@
+"""scoring.py - Deferred, contention-free score keeping. Ending a game only
+queues a task. That task writes one ScoreEvent per player, each its own
+entity group, and a coalesced aggregation task later folds pending events
+into the Score entities in batches. No request ever writes to a Score, so
+a user finishing many games at once never makes it a write hotspot."""
+
+import datetime
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Score, ScoreEvent
+import leaderboard
+
+RECORD_SCORES_URL = '/tasks/record_scores'
+AGGREGATE_SCORES_URL = '/tasks/aggregate_scores'
+# Pending events are folded into Scores at most this often, in seconds
+AGGREGATE_INTERVAL = 10
+AGGREGATE_BATCH_SIZE = 200
+# Each Score is updated in a cross-group transaction with its events, which
+# may span at most 25 entity groups
+EVENTS_PER_TRANSACTION = 24
+EVENT_RETENTION = datetime.timedelta(days=7)
+
+
+@ndb.tasklet
+def queue_game_scores_async(game):
+    """Queues recording the scores of a finished game. Call inside the
+    transaction that ends the game so scores are recorded exactly when the
+    game really ended."""
+    if game.players > 1:
+        task = taskqueue.Task(url=RECORD_SCORES_URL,
+                              params={'game_key': game.key.urlsafe()})
+        yield taskqueue.Queue().add_async(task, transactional=True)
+
+
+def signup_event(user_key, user_name):
+    """Returns the ScoreEvent that adds a new user to the scores. Aggregating
+    it creates their Score and counts them in the leaderboard histogram, so
+    signing up never writes to the histogram itself."""
+    return ScoreEvent(id='signup:{}'.format(user_key.id()), user=user_key,
+                      user_name=user_name)
+
+
+def record_game_scores(game):
+    """Writes a ScoreEvent for every player in a finished game. Events are
+    keyed by game and user, so running this again never double counts."""
+    futures = []
+    for seat in game.get_seats():
+        won = seat.user == game.winner
+        futures.append(ScoreEvent.get_or_insert_async(
+            ScoreEvent.id_for(game.key, seat.user),
+            user=seat.user,
+            user_name=seat.user_name,
+            games=1,
+            wins=1 if won else 0,
+            score=game.turn if won else 0))
+    ndb.Future.wait_all(futures)
+    schedule_aggregation()
+
+
+def schedule_aggregation():
+    """Queues an aggregation run. Every caller within the same interval
+    shares one named task, so a burst of finished games costs one run."""
+    window = int(time.time() // AGGREGATE_INTERVAL)
+    try:
+        taskqueue.add(url=AGGREGATE_SCORES_URL,
+                      name='aggregate-scores-{}'.format(window),
+                      countdown=AGGREGATE_INTERVAL)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+@ndb.transactional(xg=True)
+def _apply_events(user_key, event_keys):
+    """Adds unapplied events to a user's Score. The change in score is
+    recorded on the last event applied, in the same transaction, for the
+    leaderboard histogram to count. Returns that event's key, or None if
+    the score did not change."""
+    score_key = Score.key_for(user_key)
+    entities = ndb.get_multi([score_key] + event_keys)
+    score, events = entities[0], entities[1:]
+    old_score = score.score if score else None
+    if score is None:
+        score = Score(key=score_key, user=user_key)
+    updated = []
+    for event in events:
+        if event is None or event.applied:
+            continue
+        score.user_name = event.user_name
+        score.games += event.games
+        score.wins += event.wins
+        score.score += event.score
+        event.applied = True
+        updated.append(event)
+    if not updated:
+        return None
+    changed = old_score != score.score
+    if changed:
+        updated[-1].populate(histogram_pending=True,
+                             histogram_from=old_score,
+                             histogram_to=score.score)
+    ndb.put_multi([score] + updated)
+    return updated[-1].key if changed else None
+
+
+def aggregate_scores():
+    """Folds a batch of pending ScoreEvents into Scores, one transaction
+    per user, and updates the leaderboard once for the whole batch. Returns
+    True if there may be more events waiting."""
+    events = (ScoreEvent.query(ScoreEvent.applied == False)
+                        .fetch(AGGREGATE_BATCH_SIZE))
+    by_user = {}
+    for event in events:
+        by_user.setdefault(event.user, []).append(event.key)
+    changed = []
+    for user_key, keys in by_user.iteritems():
+        for start in range(0, len(keys), EVENTS_PER_TRANSACTION):
+            changed.append(_apply_events(
+                user_key, keys[start:start + EVENTS_PER_TRANSACTION]))
+    # Also picks up changes a failed run left uncounted
+    more = leaderboard.count_score_events(
+        [key for key in changed if key is not None])
+    if events:
+        leaderboard.scores_changed()
+    # Applied events only need to outlive any retry of the task that
+    # recorded them, and any change they carry must be counted first
+    cutoff = datetime.datetime.now() - EVENT_RETENTION
+    ndb.delete_multi([event.key for event in
+                      ScoreEvent.query(ScoreEvent.applied == True,
+                                       ScoreEvent.created < cutoff)
+                                .fetch(AGGREGATE_BATCH_SIZE)
+                      if not event.histogram_pending])
+    return more or len(events) == AGGREGATE_BATCH_SIZE
@@ -0,0 +1,90 @@
+"""sweeper.py - Ends abandoned games. A game nobody has moved in for
+IDLE_GAME_TIMEOUT is timed out: if any bid was made the player who failed
+to move forfeits to the last bidder, otherwise the game is cancelled.
+Forfeits are scored like any other ended game, through score events that
+are folded into Scores in batches."""
+
+import datetime
+import logging
+import os
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Game, Player
+from utils import cache_entity
+import scoring
+
+SWEEP_GAMES_URL = '/tasks/sweep_games'
+SWEEP_BATCH_SIZE = 50
+# Seconds a game may wait on a move before it is timed out
+IDLE_GAME_TIMEOUT = int(os.environ.get('IDLE_GAME_TIMEOUT',
+                                       7 * 24 * 60 * 60))
+CUTOFF_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def queue_sweep(cutoff, cursor=None):
+    """Queues timing out the next batch of games idle since before cutoff"""
+    params = {'cutoff': cutoff.strftime(CUTOFF_FORMAT)}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    taskqueue.add(url=SWEEP_GAMES_URL, params=params)
+
+
+def start_sweep():
+    """Starts a sweep of games idle for longer than IDLE_GAME_TIMEOUT"""
+    queue_sweep(datetime.datetime.utcnow() -
+                datetime.timedelta(seconds=IDLE_GAME_TIMEOUT))
+
+
+def sweep_batch(cutoff, urlsafe_cursor=None):
+    """Times out one batch of games idle since before cutoff, formatted
+    with CUTOFF_FORMAT, and queues the next"""
+    cutoff = datetime.datetime.strptime(cutoff, CUTOFF_FORMAT)
+    cursor = Cursor(urlsafe=urlsafe_cursor) if urlsafe_cursor else None
+    games, next_cursor, more = (
+        Game.query(Game.finished == False, Game.last_move < cutoff)
+            .fetch_page(SWEEP_BATCH_SIZE, start_cursor=cursor))
+    # The player who let a game lapse forfeits to the last bidder. Null
+    # sorts before every date, so games whose idle clock the last_moves
+    # migration has not started yet are found too and left alone.
+    timed_out = [_time_out(game.key, game.players, game.turn, cutoff,
+                           game.bidding_seat().user if game.turn else None)
+                 for game in games if game.last_move is not None]
+    for future in timed_out:
+        game = future.get_result()
+        if game:
+            cache_entity(game)
+    if more and next_cursor:
+        queue_sweep(cutoff, next_cursor)
+    else:
+        logging.info('Sweep finished.')
+
+
+@ndb.transactional_tasklet
+def _time_out(game_key, players, turn, cutoff, winner):
+    """Ends an idle game with a winner, or cancels it if no bid was made,
+    unless a move was made since it was found. Returns the ended game, or
+    None if it was left alone."""
+    game, player_entities = yield (
+        game_key.get_async(),
+        ndb.get_multi_async(Player.keys_for(game_key, players)))
+    if (game.game_over or game.cancelled or game.turn != turn or
+            game.last_move is None or game.last_move >= cutoff):
+        raise ndb.Return(None)
+    futures = []
+    if winner:
+        game.game_over = True
+        game.winner = winner
+        futures.append(scoring.queue_game_scores_async(game))
+    else:
+        game.cancelled = True
+    game.version += 1
+    player_entities = [player for player in player_entities
+                       if player is not None]
+    for player in player_entities:
+        player.active = False
+    futures.append(ndb.put_multi_async([game] + player_entities))
+    yield futures
+    raise ndb.Return(game)
@@ -1,11 +1,115 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 import endpoints
 
+# How long cached entities live in memcache, in seconds
+CACHE_TIME = 60 * 60
+# How many times a write-through retries a compare-and-set before giving up
+# and dropping the cached copy instead
+CAS_RETRIES = 3
+# Per-instance cache counters
+CACHE_STATS = {'hits': 0, 'misses': 0, 'writes': 0, 'invalidations': 0}
+
+
+def _cache_key(key):
+    return 'entity:' + key.urlsafe()
+
+
+def _is_stale(entity, cached):
+    """Returns True if entity is older than the cached copy. Only entities
+    with a version stamp can be compared, others always replace the cache."""
+    version = getattr(entity, 'version', None)
+    cached_version = getattr(cached, 'version', None)
+    if version is None or cached_version is None:
+        return False
+    return version <= cached_version
+
+
+@ndb.tasklet
+def cache_entity_async(entity):
+    """Writes an entity through to memcache once its changes are committed.
+    Uses compare-and-set, so a slow writer holding an older version never
+    replaces a newer copy written by another instance. Returns a Future
+    whose result is True if the cache holds this version or newer."""
+    context = ndb.get_context()
+    cache_key = _cache_key(entity.key)
+    for _ in range(CAS_RETRIES):
+        cached = yield context.memcache_get(cache_key, for_cas=True)
+        if cached is None:
+            added = yield context.memcache_add(cache_key, entity,
+                                               time=CACHE_TIME)
+            if added:
+                CACHE_STATS['writes'] += 1
+                raise ndb.Return(True)
+        elif _is_stale(entity, cached):
+            raise ndb.Return(True)
+        else:
+            swapped = yield context.memcache_cas(cache_key, entity,
+                                                 time=CACHE_TIME)
+            if swapped:
+                CACHE_STATS['writes'] += 1
+                raise ndb.Return(True)
+    # Lost the race too often, let the next read reload it
+    CACHE_STATS['invalidations'] += 1
+    yield context.memcache_delete(cache_key)
+    raise ndb.Return(False)
+
+
+def cache_entity(entity):
+    """Synchronous cache_entity_async"""
+    return cache_entity_async(entity).get_result()
+
+
+def invalidate(key):
+    """Drops the cached copy of an entity"""
+    CACHE_STATS['invalidations'] += 1
+    memcache.delete(_cache_key(key))
+
+
+def get_cached(key):
+    """Returns the entity for key, reading through memcache"""
+    entity = memcache.get(_cache_key(key))
+    if entity is not None:
+        CACHE_STATS['hits'] += 1
+        return entity
+    CACHE_STATS['misses'] += 1
+    entity = key.get()
+    if entity is not None:
+        cache_entity(entity)
+    return entity
+
+
+def get_multi_cached(keys):
+    """Returns the entities for keys, reading through memcache with one
+    batched lookup. Misses are fetched with one get_multi and only added to
+    the cache, so they never replace a newer copy."""
+    cached = memcache.get_multi([_cache_key(key) for key in keys])
+    entities = [cached.get(_cache_key(key)) for key in keys]
+    missing = [key for key, entity in zip(keys, entities) if entity is None]
+    CACHE_STATS['hits'] += len(keys) - len(missing)
+    CACHE_STATS['misses'] += len(missing)
+    if missing:
+        fetched = dict(zip(missing, ndb.get_multi(missing)))
+        memcache.add_multi(dict((_cache_key(key), entity)
+                                for key, entity in fetched.iteritems()
+                                if entity is not None),
+                           time=CACHE_TIME)
+        entities = [entity if entity is not None else fetched[key]
+                    for key, entity in zip(keys, entities)]
+    return entities
+
+
+def cache_stats():
+    """Returns this instance's cache counters"""
+    return dict(CACHE_STATS)
+
+
 def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
+    """Returns an ndb.Model entity that the urlsafe key points to, reading
+    through the memcache entity cache. Checks
         that the type of entity returned is of the correct kind. Raises an
         error if the key String is malformed or the entity is of the incorrect
         kind
@@ -17,8 +121,30 @@ def get_by_urlsafe(urlsafe, model):
         exists.
     Raises:
         ValueError:"""
+    entity = get_cached(_key_from_urlsafe(urlsafe))
+    if not entity:
+        return None
+    if not isinstance(entity, model):
+        raise ValueError('Incorrect Kind')
+    return entity
+
+
+def get_multi_by_urlsafe(urlsafes, model):
+    """Returns the ndb.Model entities that a list of urlsafe keys point to,
+    reading through the memcache entity cache in one batch. Missing
+    entities are returned as None. Raises the same errors as
+    get_by_urlsafe."""
+    entities = get_multi_cached([_key_from_urlsafe(urlsafe)
+                                 for urlsafe in urlsafes])
+    for entity in entities:
+        if entity is not None and not isinstance(entity, model):
+            raise ValueError('Incorrect Kind')
+    return entities
+
+
+def _key_from_urlsafe(urlsafe):
     try:
-        key = ndb.Key(urlsafe=urlsafe)
+        return ndb.Key(urlsafe=urlsafe)
     except TypeError:
         raise endpoints.BadRequestException('Invalid Key')
     except Exception, e:
@@ -26,10 +152,3 @@ def get_by_urlsafe(urlsafe, model):
             raise endpoints.BadRequestException('Invalid Key')
         else:
             raise
-
-    entity = key.get()
-    if not entity:
-        return None
-    if not isinstance(entity, model):
-        raise ValueError('Incorrect Kind')
-    return entity